@@ -0,0 +1,259 @@
+"""
+Headless rendering benchmark of the TUI components.
+
+Renders `MainForm`'s components against a recording fake terminal, for a sweep of terminal sizes
+and directory listing sizes, and reports per frame: render time, `addstr` calls and an estimate
+of the bytes curses would send to the terminal (changed cells and cursor moves).
+
+    python benchmark.py --sizes 80x24,200x60 --entries 100,10000 --frames 200
+"""
+import argparse
+import curses
+import json
+import logging
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+import db
+
+# Cost of moving the cursor to a changed run of cells, as in "\x1b[12;40H"
+CURSOR_MOVE_BYTES = 8
+SCENARIOS = ('idle', 'tick', 'scroll', 'popup', 'redraw')
+
+
+class Terminal:
+    """
+    Virtual and physical screen of the fake terminal. `doupdate` sends the cells that differ.
+    """
+
+    def __init__(self, lines, cols):
+        self.lines = lines
+        self.cols = cols
+        self.virtual = {}
+        self.physical = {}
+        self.addstr_calls = 0
+        self.bytes_written = 0
+        # Time spent emulating the terminal, not counted as render time
+        self.overhead = 0.0
+
+    def doupdate(self):
+        start = time.perf_counter()
+        changed = sorted(cell for cell, ch in self.virtual.items() if self.physical.get(cell) != ch)
+        last = None
+        for y, x in changed:
+            if last != (y, x - 1):
+                self.bytes_written += CURSOR_MOVE_BYTES
+            self.bytes_written += len(self.virtual[y, x].encode())
+            last = (y, x)
+        self.physical = dict(self.virtual)
+        self.overhead += time.perf_counter() - start
+
+
+class RecordingWindow:
+    """
+    Fake curses window recording what is drawn into it. Behaves like curses where the components
+    rely on it: long lines wrap, writing up to the last cell fails, and only `noutrefresh` copies
+    the window to the screen.
+    """
+
+    def __init__(self, terminal: Terminal, lines, cols, begin_y=0, begin_x=0):
+        self.terminal = terminal
+        self.lines = lines
+        self.cols = cols
+        self.begin_y = begin_y
+        self.begin_x = begin_x
+        self.cells = {}
+
+    def getmaxyx(self):
+        return self.lines, self.cols
+
+    def addstr(self, y, x, text, *args):
+        self.terminal.addstr_calls += 1
+        start = y * self.cols + x
+        end = min(start + len(text), self.lines * self.cols)
+        for pos in range(start, end):
+            self.cells[divmod(pos, self.cols)] = text[pos - start]
+        # The cursor can't move past the last cell
+        if end == self.lines * self.cols:
+            raise curses.error('addstr() returned ERR')
+
+    def insstr(self, y, x, text, *args):
+        self.terminal.addstr_calls += 1
+        for i, ch in enumerate(text[:self.cols - x]):
+            self.cells[y, x + i] = ch
+
+    def attron(self, attr):
+        pass
+
+    def attroff(self, attr):
+        pass
+
+    def erase(self):
+        self.cells = {}
+
+    clear = erase
+
+    def noutrefresh(self):
+        start = time.perf_counter()
+        virtual = self.terminal.virtual
+        for y in range(self.lines):
+            for x in range(self.cols):
+                virtual[self.begin_y + y, self.begin_x + x] = self.cells.get((y, x), ' ')
+        self.terminal.overhead += time.perf_counter() - start
+
+
+def patch_curses(terminal: Terminal):
+    """
+    Route the module level curses functions the components call to the fake terminal.
+    """
+    curses.newwin = lambda lines, cols, y, x: RecordingWindow(terminal, lines, cols, y, x)
+    curses.doupdate = terminal.doupdate
+    curses.color_pair = lambda n: n << 8
+    curses.curs_set = lambda visibility: None
+
+
+def create_library(root, entries) -> str:
+    """
+    Create a directory of empty media files with saved durations, so nothing is probed.
+    """
+    dirpath = os.path.join(root, f'library-{entries}')
+    os.makedirs(dirpath, exist_ok=True)
+    conn = db.connect()
+    for i in range(entries):
+        filepath = os.path.join(dirpath, f'Episode {i + 1}.mp4')
+        open(filepath, 'w').close()
+        stat = os.stat(filepath)
+        db.upsert_media(conn.cursor(), filepath, 20 * 60_000 + i, stat.st_size, stat.st_mtime_ns,
+                        stoptime=i * 1000 if i % 3 == 1 else None, was_played=i % 3 == 2)
+    conn.commit()
+    conn.close()
+    return dirpath
+
+
+def render(components, popup, status):
+    """
+    Same as `MainForm.render`, which can't be used without a player.
+    """
+    drawn = False
+    for component in components:
+        drawn = component.render(status) or drawn
+    if popup:
+        popup.dirty |= drawn
+        popup.render()
+    curses.doupdate()
+
+
+def run_scenario(scenario, size, dirpath, frames, cursor, writer, prober, prefetcher) -> dict:
+    from components import ControlsBox, DirectoryMenu, NowPlaying, QuitDialog
+
+    lines, cols = size
+    terminal = Terminal(lines, cols)
+    patch_curses(terminal)
+    stdscr = RecordingWindow(terminal, lines, cols)
+
+    menu = DirectoryMenu(stdscr, dirpath, cursor, writer, prober, prefetcher, lambda: None,
+                         lambda callback=None: None)
+    menu.wait_for_items(len(menu.view.listing.entries) if menu.view.listing else 0)
+    components = [menu, ControlsBox(stdscr), NowPlaying(stdscr)]
+    menu.activate()
+    popup = None
+    if scenario == 'popup':
+        popup = QuitDialog(stdscr, lambda: None)
+        popup.activate()
+    status = {'time': 0, 'state': 'playing', 'title': 'Episode 2', 'length': 20 * 60_000}
+    # First frame draws everything
+    render(components, popup, status)
+
+    times, calls, written = [], [], []
+    for frame in range(frames):
+        terminal.addstr_calls = terminal.bytes_written = 0
+        terminal.overhead = 0.0
+        start = time.perf_counter()
+        if scenario in ('tick', 'popup'):
+            # A playback tick: while playing, the position advances and is redrawn once a second,
+            # below the quit dialog in the popup scenario
+            status['time'] += 1000
+        elif scenario == 'scroll':
+            menu.receive_input('KEY_DOWN')
+            menu.dirty = True
+        elif scenario == 'redraw':
+            for component in components:
+                component.dirty = True
+        render(components, popup, status)
+        times.append(time.perf_counter() - start - terminal.overhead)
+        calls.append(terminal.addstr_calls)
+        written.append(terminal.bytes_written)
+
+    return {
+        'scenario': scenario,
+        'size': f'{cols}x{lines}',
+        'entries': len(menu._items),
+        'frame_ms': statistics.mean(times) * 1000,
+        'frame_ms_max': max(times) * 1000,
+        'addstr_per_frame': statistics.mean(calls),
+        'bytes_per_frame': statistics.mean(written),
+    }
+
+
+def parse_size(value):
+    cols, lines = value.lower().split('x')
+    return int(lines), int(cols)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Headless rendering benchmark of the TUI components")
+    parser.add_argument("--sizes", default="80x24,120x40,200x60",
+                        help="Comma separated terminal sizes as COLSxLINES")
+    parser.add_argument("--entries", default="100,1000,10000",
+                        help="Comma separated numbers of media files in the listed directory")
+    parser.add_argument("--frames", type=int, default=200, help="Frames rendered per run")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS),
+                        help=f"Comma separated scenarios out of {', '.join(SCENARIOS)}")
+    parser.add_argument("--json", action="store_true", help="Print results as JSON lines")
+    args = parser.parse_args()
+
+    logging.disable(logging.WARNING)
+    sizes = [parse_size(size) for size in args.sizes.split(',')]
+    entries = [int(count) for count in args.entries.split(',')]
+    scenarios = args.scenarios.split(',')
+
+    from db import MediaWriter, init_database
+    from prefetch import Prefetcher
+    from probe import Prober
+
+    with tempfile.TemporaryDirectory(prefix='vlc-tui-bench-') as root:
+        db.DATABASE_PATH = os.path.join(root, 'media.db')
+        conn = init_database()
+        writer = MediaWriter()
+        writer.start()
+        prober = Prober(1, 'mp4')
+        prefetcher = Prefetcher(writer, delay=3600)
+        try:
+            libraries = {count: create_library(root, count) for count in entries}
+            if not args.json:
+                print(f"{'scenario':<8} {'size':>8} {'entries':>8} {'ms/frame':>9} {'max ms':>8} "
+                      f"{'addstr':>8} {'bytes':>8}")
+            for count in entries:
+                for size in sizes:
+                    for scenario in scenarios:
+                        result = run_scenario(scenario, size, libraries[count], args.frames,
+                                              conn.cursor(), writer, prober, prefetcher)
+                        if args.json:
+                            print(json.dumps(result))
+                        else:
+                            print(f"{result['scenario']:<8} {result['size']:>8} {result['entries']:>8} "
+                                  f"{result['frame_ms']:>9.3f} {result['frame_ms_max']:>8.3f} "
+                                  f"{result['addstr_per_frame']:>8.1f} {result['bytes_per_frame']:>8.0f}")
+                        sys.stdout.flush()
+        finally:
+            prefetcher.shutdown()
+            prober.shutdown()
+            writer.close()
+            conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -2,3 +2,4 @@ from .controls_box import ControlsBox
 from .directory_menu import DirectoryMenu
 from .now_playing import NowPlaying
 from .quit_dialog import QuitDialog
+from .search_dialog import SearchDialog
@@ -1,9 +1,22 @@
 import curses
 import logging
 
+BACKSPACE_KEYS = ('KEY_BACKSPACE', '\b', '\x7f')
+ESCAPE_KEY = '\x1b'
+
 
 class BaseComponent:
+    """
+    Box on the screen, drawn into its own curses window.
+
+    The window is only drawn when the component is marked `dirty` or the part of the status it shows
+    changed, see `status_key`. Drawn windows are copied to the screen with `noutrefresh`, and
+    `MainForm.render` sends all of them to the terminal at once.
+    """
     component = None
+    window = None
+    dirty = True
+    drawn_status = None
     startx = 0
     starty = 0
     endx = 0
@@ -11,6 +24,8 @@ class BaseComponent:
     title = None
     popup = False
     interactive = False
+    # Text input components receive every key, including global shortcuts
+    text_input = False
 
     def __init__(self, stdscr):
         self.stdscr = stdscr
@@ -19,50 +34,72 @@ class BaseComponent:
     def restart(self):
         raise NotImplementedError
 
+    def create_window(self):
+        """
+        Create the window covering the box of the component. Inner components draw into it
+        with coordinates relative to the box.
+        """
+        scry, scrx = self.stdscr.getmaxyx()
+        height = min(self.endy, scry - 1) - self.starty + 1
+        width = min(self.endx, scrx - 1) - self.startx + 1
+        self.window = curses.newwin(height, width, self.starty, self.startx)
+        self.dirty = True
+        return self.window
+
     def activate(self):
         curses.curs_set(0)
         self.component.active = True
+        self.dirty = True
 
     def deactivate(self):
         curses.curs_set(1)
         self.component.active = False
+        self.dirty = True
 
     def create_border(self, color):
-        self.stdscr.attron(curses.color_pair(color))
+        bottom = self.endy - self.starty
+        right = self.endx - self.startx
+        self.window.attron(curses.color_pair(color))
 
         # vertical borders
-        for i in range(self.starty + 1, self.endy):
-            self.stdscr.addstr(i, self.startx, "│")
-            self.stdscr.addstr(i, self.endx, "│")
-
-        # horizontal borders
-        for i in range(self.startx + 1, self.endx):
-            self.stdscr.addstr(self.starty, i, "─")
-            self.stdscr.addstr(self.endy, i, "─")
-
-        # top left corner
-        self.stdscr.addstr(self.starty, self.startx, "╭")
+        for i in range(1, bottom):
+            self.window.addstr(i, 0, "│")
+            self.window.addstr(i, right, "│")
 
-        # top right corner
-        self.stdscr.addstr(self.starty, self.endx, "╮")
-
-        # bottom left corner
-        self.stdscr.addstr(self.endy, self.startx, "╰")
-
-        # bottom right corner
-        self.stdscr.addstr(self.endy, self.endx, "╯")
+        # horizontal borders and corners
+        self.window.addstr(0, 0, "╭" + "─" * (right - 1) + "╮")
+        self.window.addstr(bottom, 0, "╰" + "─" * (right - 1))
+        # addstr fails on the last cell of a window, as the cursor can't move past it
+        self.window.insstr(bottom, right, "╯")
 
         # title
         if self.title:
-            self.stdscr.addstr(self.starty, self.startx + 2, " " + self.title + " ")
-
-        self.stdscr.attroff(curses.color_pair(color))
-
-    def render(self, status=None):
+            self.window.addstr(0, 2, " " + self.title + " ")
+
+        self.window.attroff(curses.color_pair(color))
+
+    def status_key(self, status):
+        """
+        Returns the part of the status the component shows. It is redrawn whenever this changes.
+        """
+        return None
+
+    def render(self, status=None) -> bool:
+        """
+        Draw the component if it changed since it was last drawn. Returns whether it was drawn.
+        """
+        drawn_status = self.status_key(status)
+        if not self.dirty and drawn_status == self.drawn_status:
+            return False
+        self.window.erase()
+        self.draw(status)
+        self.window.noutrefresh()
+        self.dirty = False
+        self.drawn_status = drawn_status
+        return True
+
+    def draw(self, status=None):
         if self.popup:
-            for x in range(self.startx, self.endx + 1):
-                for y in range(self.starty, self.endy + 1):
-                    self.stdscr.addstr(y, x, " ")
             self.create_border(10)
         elif self.interactive:
             self.create_border(5 if self.component.active else 4)
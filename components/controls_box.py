@@ -12,7 +12,7 @@ class ControlsBox(BaseComponent):
         self.starty = 0
         self.endy = scry - 8
         self.component = Menu(
-            self.stdscr, self.items, self.starty, self.startx, self.endy, self.endx
+            self.create_window(), self.items, 0, 0, self.endy - self.starty, self.endx - self.startx
         )
 
     @property
@@ -23,9 +23,14 @@ class ControlsBox(BaseComponent):
             f"[←] Skip {SEEK_STEP}s backward",
             "[P] Previous track",
             "[N] Next track",
+            "[R] Change repeat mode",
+            "[Z] Toggle shuffle",
             "[G] Scroll to top",
             "[⇧+G] Scroll to bottom",
             "[O] Skip opening (+90s)",
+            "[S] Change sort order",
+            "[/] Filter listing",
             "[M] Mark as played",
+            "[F] Find in library",
             "[Q] Quit",
         ]
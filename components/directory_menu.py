@@ -1,28 +1,62 @@
 import curses
 import logging
 import os
+from collections import OrderedDict
+from functools import partial
+from threading import Thread
 
-from item import DirectoryItem, sort_items
+from db import connect, get_directory_rollups
+from item import DirectoryItem, DirectoryListing, DirectoryView, ListingFilter
 from menu import Column, TableMenu
-from util import SUPPORTED_EXTS, get_media_length, ms_to_hms
+from util import (DIRECTORY_CACHE_SIZE, SORT_MODE, SORT_MODES, SUPPORTED_EXTS,
+                  get_media_length, is_supported, ms_to_hms)
+from watcher import DirectoryWatcher
 
-from components.base import BaseComponent
+from components.base import BACKSPACE_KEYS, ESCAPE_KEY, BaseComponent
+
+SORT_LABELS = {
+    'name': 'by name',
+    'duration': 'by duration',
+    'unwatched': 'unwatched first',
+    'in_progress': 'in progress first',
+    'recent': 'recently played first',
+}
 
 
 class DirectoryMenu(BaseComponent):
 
-    def __init__(self, stdscr, filepath, cursor, select_handler):
+    def __init__(self, stdscr, filepath, cursor, writer, prober, prefetcher, select_handler, update_handler,
+                 sort_mode=SORT_MODE):
         self.stdscr = stdscr
         self.filepath = filepath
         self.cursor = cursor
+        self.writer = writer
+        self.prober = prober
+        self.prefetcher = prefetcher
+        self.probe_job = None
         self.select_handler = select_handler
-        self.title = self.filepath
+        self.update_handler = update_handler
+        self.sort_mode = sort_mode
         self.interactive = True
+        # Recently visited directories, least recently used first
+        self.views = OrderedDict()
+        self.view = None
+        # Type-ahead filter of the listing while it is being typed, see `start_filter`
+        self.filter = None
+        # Changes seen while the listing is still loading, applied once it is complete
+        self.pending_changes = set()
+        try:
+            self.watcher = DirectoryWatcher(self.on_directory_changed)
+            self.watcher.start()
+        except OSError:
+            logging.warning("inotify is not available, directory changes won't be shown until rescan")
+            self.watcher = None
+        self.load_directory()
         self.restart()
 
     def restart(self):
         """
-        Scan the directory and draw the menu.
+        Lay out and draw the menu, keeping the current listing and position.
         """
         scry, scrx = self.stdscr.getmaxyx()
         self.startx = 0
@@ -30,69 +64,387 @@ class DirectoryMenu(BaseComponent):
         self.starty = 0
         self.endy = scry - 8
 
-        # Draw UI placeholder while program scans directory - ???
-        self.scan_directory()
+        if self.component:
+            self.save_position()
+        self.create_window()
+        self.create_menu()
 
+    def create_menu(self):
+        position = self.view if self.filter is None else self.filter
         self.component = TableMenu(
-            self.stdscr,
+            self.window,
             [
                 Column('was_played', 2, 'right'),
                 Column('title'),
                 Column('duration', len("00:00:00") + 2, 'center'),
             ],
             self.items,
-            self.starty,
-            self.startx,
-            self.endy,
-            self.endx,
+            0,
+            0,
+            self.endy - self.starty,
+            self.endx - self.startx,
             self.component and self.component.active,
-            self.component.selected
-            if self.component and self.component.selected
-            else 0,
-            self.component.scroll_start
-            if self.component and self.component.scroll_start
-            else 0,
+            position.selected,
+            position.scroll_start,
         )
+        self.component.scroll_to_selected()
+        self.dirty = True
+
+    def save_position(self):
+        # While filtering, this is the position in the matches
+        position = self.view if self.filter is None else self.filter
+        position.selected = self.component.selected
+        position.scroll_start = self.component.scroll_start
+
+    def show_position(self):
+        """
+        Show the rows and the saved position of the listing, or of the matches while filtering.
+        """
+        position = self.view if self.filter is None else self.filter
+        self.component.items = self.items
+        self.component.selected = position.selected
+        self.component.scroll_start = position.scroll_start
+        self.component.items_changed()
+        self.dirty = True
+
+    def load_directory(self):
+        """
+        Show the cached listing of the current directory, or scan it if it changed since.
+        """
+        mtime = os.stat(self.filepath).st_mtime_ns
+        view = self.views.get(self.filepath)
+        if view and view.mtime == mtime:
+            logging.info(f'Using cached listing of {self.filepath}')
+            self.views.move_to_end(self.filepath)
+        else:
+            view = self.prefetcher.take(self.filepath)
+            if view and view.mtime == mtime:
+                logging.info(f'Using prefetched listing of {self.filepath}')
+                if view.listing:
+                    self.continue_listing(view)
+            else:
+                view = self.scan_directory(mtime)
+            if self.filepath in self.views:
+                # Directory changed since it was cached, keep the cursor on the same item
+                old = self.views[self.filepath]
+                selected = old.items.names[old.items.order[old.selected]]
+                view.selected = view.items.find(selected) or 0
+                view.scroll_start = old.scroll_start
+            self.views[self.filepath] = view
+            if len(self.views) > DIRECTORY_CACHE_SIZE:
+                _, evicted = self.views.popitem(last=False)
+                if evicted.listing:
+                    evicted.listing.cancelled = True
+        self.sort_view(view)
+        self.load_rollups(view)
+        self.view = view
+        self.pending_changes = set()
+        self._items = view.items
+        if self.watcher:
+            self.watcher.watch(self.filepath)
+
+        # Files with unknown durations are listed with a placeholder and probed in the background
+        if self.probe_job:
+            self.probe_job.cancel()
+        self.probe_job = self.prober.submit(self._items, self.row_probed, self.update_handler)
+
+    def load_rollups(self, view: DirectoryView):
+        """
+        Show the watch progress of the subdirectories from the database, also in a cached listing,
+        without reading them. They are read once the savepoints queued so far are committed.
+        """
+        self.writer.flush(wait=False, callback=partial(self.update_handler, partial(self.rollups_saved, view)))
+
+    def rollups_saved(self, view: DirectoryView):
+        view.items.set_rollups(get_directory_rollups(self.cursor, view.items.dirpath))
+        if view is self.view:
+            self.dirty = True
+
+    def scan_directory(self, mtime) -> DirectoryView:
+        listing = DirectoryListing(self.writer, self.filepath)
+        view = DirectoryView(listing.items, mtime, listing=listing)
+        self.continue_listing(view)
+        return view
+
+    def continue_listing(self, view: DirectoryView):
+        """
+        Load the first chunk of the listing right away, unless it has one already, and the rest in the background.
+        """
+        listing = view.listing
+        if not listing.position:
+            listing.load_chunk(self.cursor)
+        if listing.loaded:
+            view.listing = None
+        else:
+            Thread(target=self.load_listing, args=(listing,), name='listing-loader', daemon=True).start()
+
+    def load_listing(self, listing: DirectoryListing):
+        conn = connect()
+        try:
+            while not listing.loaded and not listing.cancelled:
+                items = listing.load_chunk(conn.cursor())
+                self.update_handler(partial(self.chunk_loaded, listing, items))
+        finally:
+            conn.close()
+        if listing.loaded:
+            # Runs after the callbacks of all chunks
+            self.update_handler(partial(self.listing_loaded, listing))
+
+    def chunk_loaded(self, listing: DirectoryListing, items):
+        if listing is not self.view.listing:
+            # Not shown at the moment, rows are created when the directory is entered again
+            return
+        self.component.items_changed()
+        self.dirty = True
+        self.prober.submit(items, self.row_probed, self.update_handler, self.probe_job)
+        if listing.loaded:
+            self.resort()
+        if listing.loaded and self.pending_changes:
+            names, self.pending_changes = self.pending_changes, set()
+            self.apply_changes(self.filepath, names)
+
+    def listing_loaded(self, listing: DirectoryListing):
+        # The entries are only needed for loading, the views keep their items
+        for view in self.views.values():
+            if view.listing is listing:
+                view.listing = None
+
+    def wait_for_items(self, count):
+        """
+        Load chunks of a listing that is still loading until `count` items are available.
+        """
+        if self.view.loaded or count <= len(self._items):
+            return
+        items = self.view.listing.load_until(self.cursor, count)
+        self.component.items_changed()
+        self.prober.submit(items, self.row_probed, self.update_handler, self.probe_job)
+
+    def sort_view(self, view: DirectoryView):
+        """
+        Re-sort a completely loaded listing in the current sort mode, keeping the selected item.
+        Listings still loading are in name order, they are sorted once the last chunk is loaded.
+        """
+        store = view.items
+        if not view.loaded or store.sort_mode == self.sort_mode or not len(store):
+            return
+        selected = store.order[view.selected]
+        store.sort(self.sort_mode)
+        view.selected = store.order.index(selected)
+
+    def resort(self):
+        """
+        Re-sort the shown listing in the current sort mode.
+        """
+        self.save_position()
+        self.sort_view(self.view)
+        if self.filter is not None:
+            # Matches follow the new order
+            self.filter.refresh()
+        self.show_position()
+
+    def cycle_sort_mode(self):
+        self.sort_mode = SORT_MODES[(SORT_MODES.index(self.sort_mode) + 1) % len(SORT_MODES)]
+        logging.info(f'Sorting listings {SORT_LABELS[self.sort_mode]}')
+        if self.view.listing:
+            self.wait_for_items(len(self.view.listing.entries))
+        self.resort()
 
-    def scan_directory(self):
-        logging.info(f'Scanning directory: {self.filepath}')
-        items = []
-        if self.filepath != '/':
-            items.append(DirectoryItem(self.cursor, self.filepath + '/..'))
+    def row_probed(self, item: DirectoryItem):
+        # Rows are formatted from the store on render, the row was invalidated with the new duration
+        if item.store is self._items:
+            self.dirty = True
 
-        for item in os.listdir(self.filepath):
-            if item.startswith('.'):
+    def on_directory_changed(self, dirpath, names):
+        self.update_handler(partial(self.apply_changes, dirpath, names))
+
+    def apply_changes(self, dirpath, names):
+        """
+        Insert, remove or replace only the rows of the changed entries, keeping the selection.
+        `names` is None if the changes are not known, the directory is scanned again then.
+        """
+        if dirpath != self.filepath:
+            return
+        if names is None:
+            return self.rescan()
+        if not self.view.loaded:
+            # Inserting in the middle of a listing that is still loading would break its order
+            self.pending_changes |= names
+            return
+        logging.info(f'Updating {len(names)} changed entries of {dirpath}')
+        store = self._items
+        selected = self.selected.row if len(self.shown) else None
+        new_items = []
+        for name in names:
+            if name.startswith('.'):
+                continue
+            filepath = os.path.join(dirpath, name)
+            old = None
+            idx = store.find(name)
+            if idx is not None:
+                old = store[idx]
+                del store[idx]
+
+            try:
+                stat = os.stat(filepath)
+            except FileNotFoundError:
+                continue
+            is_dir = os.path.isdir(filepath)
+            if not is_dir and not is_supported(name):
                 continue
+            # A replaced file keeps its watch state, its duration is kept only if the file is unchanged
+            details = None
+            if old and old.is_media:
+                fingerprint = (None, None) if old.needs_probe else old.fingerprint
+                details = {filepath: (old.duration, old.stoptime, old.was_played, *fingerprint, old.played_at)}
+            item = store.add(name, details, is_dir=is_dir, stat=stat)
+            store.insert_sorted(item)
+            new_items.append(item)
+            if old and old.row == selected:
+                selected = item.row
 
-            abs_path = os.path.join(self.filepath, item)
-            logging.info('Found item: ' + abs_path)
-            items.append(DirectoryItem(self.cursor, abs_path))
-        
-        self._items = list(sort_items(items))        
-        # If any new items were added, insert them into the database as one transaction.
-        self.cursor.connection.commit()
+        if self.filter is not None:
+            self.filter.refresh()
+        order = self.shown.order
+        self.component.selected = order.index(selected) if selected in order else 0
+        self.component.items_changed()
+        self.dirty = True
+        self.view.mtime = os.stat(dirpath).st_mtime_ns
+        self.prober.submit(new_items, self.row_probed, self.update_handler, self.probe_job)
+
+    def rescan(self):
+        """
+        Scan the shown directory again after changes to it were lost, keeping the selected item.
+        """
+        logging.info(f'Rescanning {self.filepath}')
+        if self.view.listing:
+            self.view.listing.cancelled = True
+        # Not the mtime of any scan, so the cached listing is not used
+        self.view.mtime = None
+        self.change_directory(self.filepath)
 
     def change_directory(self, filepath):
+        if self.filter is not None:
+            self.end_filter()
+        self.save_position()
         self.filepath = filepath
-        self.title = self.filepath
-        self.component.selected = 0
-        self.restart()
+        self.load_directory()
+        self.create_menu()
+
+    def select_filepath(self, filepath):
+        """
+        Move the selection to the item with the given path, if it is listed.
+        """
+        if os.path.dirname(filepath) != self._items.dirpath:
+            return
+        self.wait_for_items(len(self.view.listing.entries) if self.view.listing else 0)
+        idx = self._items.find(os.path.basename(filepath))
+        if idx is not None:
+            self.component.select(idx)
+            self.component.scroll_to_selected()
+
+    def status_key(self, status):
+        # The row of the playing media is highlighted
+        return status.get('title')
+
+    def start_filter(self):
+        """
+        Show only the items matching a query typed from now on, see `ListingFilter`.
+        """
+        if self.view.listing:
+            self.wait_for_items(len(self.view.listing.entries))
+        self.save_position()
+        self.filter = ListingFilter(self._items, self.selected.row if len(self._items) else None)
+        self.text_input = True
+        self.show_position()
+
+    def end_filter(self, item: DirectoryItem | None = None):
+        """
+        Show the whole listing again, with `item` selected, or the item selected before filtering.
+        """
+        row = item.row if item else self.filter.origin
+        self.filter = None
+        self.text_input = False
+        if row is not None and row in self._items.order:
+            self.view.selected = self._items.order.index(row)
+        self.show_position()
+
+    def filter_input(self, key):
+        if key == curses.KEY_ENTER or key == '\n':
+            if not len(self.filter):
+                return self.end_filter()
+            self.end_filter(self.selected)
+            self.select_handler()
+        elif key == ESCAPE_KEY:
+            self.end_filter()
+        elif key in BACKSPACE_KEYS:
+            if not self.filter.query:
+                return self.end_filter()
+            self.filter.widen()
+            self.filter.selected = self.filter.scroll_start = 0
+            self.show_position()
+        elif key in ('KEY_UP', 'KEY_DOWN'):
+            if len(self.filter):
+                self.component.receive_input(key)
+                self.hover()
+        elif len(key) == 1 and key.isprintable():
+            self.filter.narrow(self.filter.query + key)
+            self.filter.selected = self.filter.scroll_start = 0
+            self.show_position()
+
+    @property
+    def title(self):
+        title = self.filepath
+        if self.sort_mode != 'name':
+            title += f' ({SORT_LABELS[self.sort_mode]})'
+        if self.filter is not None:
+            title += f' /{self.filter.query}'
+        return title
+
+    @property
+    def shown(self):
+        """
+        Items shown in the menu: the matches while filtering, else the whole listing.
+        """
+        return self._items if self.filter is None else self.filter
 
     @property
     def items(self):
-        for item in self._items:
-            logging.info(repr(item))
-        return [item.as_row() for item in self._items]
+        return self.shown.rows
 
     @property
     def selected(self) -> DirectoryItem:
         """
         Returns the selected item. This function duplicates `.items` without metadata (only filenames)
         """
-        return self._items[self.component.selected]
+        return self.shown[self.component.selected]
 
     def receive_input(self, key):
-        if (key == curses.KEY_ENTER or key == '\n'):
+        if self.filter is not None:
+            self.filter_input(key)
+        elif (key == curses.KEY_ENTER or key == '\n'):
              self.select_handler()
+        elif key == 's':
+            self.cycle_sort_mode()
+        elif key == '/':
+            self.start_filter()
         else:
+            # Scrolling past the loaded items waits for the next chunk
+            if key == 'KEY_DOWN' and self.component.selected == len(self._items) - 1:
+                self.wait_for_items(len(self._items) + 1)
+            elif key == 'G' and self.view.listing:
+                self.wait_for_items(len(self.view.listing.entries))
             self.component.receive_input(key)
+            self.hover()
+
+    def hover(self):
+        """
+        Prefetch the selected directory if the cursor rests on it, unless its listing is cached already.
+        """
+        if not len(self.shown):
+            return
+        item = self.selected
+        dirpath = os.path.abspath(item.filepath)
+        if item.is_media or dirpath in self.views:
+            self.prefetcher.cancel_timer()
+        else:
+            self.prefetcher.schedule(dirpath)
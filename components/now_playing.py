@@ -7,6 +7,8 @@ from components.base import BaseComponent
 
 play_icon = "▶️"
 pause_icon = "⏸️"
+repeat_icons = {"off": "", "all": "↻", "one": "↻1"}
+shuffle_icon = "⤮"
 
 
 class NowPlaying(BaseComponent):
@@ -17,13 +19,18 @@ class NowPlaying(BaseComponent):
         self.starty = scry - 6
         self.endy = scry - 4
         self.component = NowPlayingComponent(
-            self.stdscr,
-            self.starty,
-            self.startx,
-            self.endy,
-            self.endx,
+            self.create_window(),
+            0,
+            0,
+            self.endy - self.starty,
+            self.endx - self.startx,
         )
 
+    def status_key(self, status):
+        # Times are shown to the second
+        return (status["state"], status.get("title"), status.get("length"), status["time"] // 1000,
+                status.get("repeat"), status.get("shuffle"))
+
 
 class NowPlayingComponent:
     def __init__(self, stdscr, starty, startx, endy, endx):
@@ -46,10 +53,16 @@ class NowPlayingComponent:
             self.track_name = status["title"]
             self.track_length = status["length"]
             self.time_elapsed = status["time"]
-            self.progress_percent = self.time_elapsed / self.track_length * 100
+            self.progress_percent = self.time_elapsed / self.track_length * 100 if self.track_length else 0
+            # The interpolated clock can run past the length until libvlc reports the end
+            self.progress_percent = min(max(self.progress_percent, 0), 100)
 
         status_symbol = play_icon if self.playing else pause_icon
-        timestamp = ms_to_hms(self.time_elapsed) + "/" + ms_to_hms(self.track_length)
+        timestamp = ms_to_hms(self.time_elapsed) + "/" + ms_to_hms(self.track_length or 0)
+        modes = " ".join(filter(None, [repeat_icons[status.get("repeat", "off")],
+                                       shuffle_icon if status.get("shuffle") else ""]))
+        if modes:
+            timestamp = modes + "  " + timestamp
 
         max_length = self.endx - self.startx - (len(timestamp) + 3)
         max_length = max_length if max_length > 0 else 0
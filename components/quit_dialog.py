@@ -29,12 +29,12 @@ class QuitDialog(BaseComponent):
         self.endy = self.starty + self.BOX_HEIGHT
 
         self.component = Menu(
-            self.stdscr,
+            self.create_window(),
             ['Yes', 'No'],
-            self.starty,
-            self.startx,
-            self.endy,
-            self.endx,
+            0,
+            0,
+            self.endy - self.starty,
+            self.endx - self.startx,
         )
 
     def receive_input(self, key):
@@ -0,0 +1,115 @@
+import curses
+import os
+from functools import partial
+from threading import Timer
+
+from db import connect, search_media
+from menu import Menu
+from util import SEARCH_DELAY, truncate
+
+from components.base import BACKSPACE_KEYS, ESCAPE_KEY, BaseComponent
+
+
+class SearchDialog(BaseComponent):
+    """
+    Popup with a query line and live library search results below it.
+    The library is searched in the background once typing pauses for `SEARCH_DELAY` seconds.
+    """
+
+    def __init__(self, stdscr, select_handler, close_handler, update_handler):
+        self.stdscr = stdscr
+        self.select_handler = select_handler
+        self.close_handler = close_handler
+        self.update_handler = update_handler
+        self.timer = None
+        self.popup = True
+        self.title = "Find in library"
+        self.interactive = True
+        self.text_input = True
+        self.query = ""
+        self.results = []
+        self.restart()
+
+    def restart(self):
+        scry, scrx = self.stdscr.getmaxyx()
+        box_width = round(scrx / 3) * 2
+        box_height = round(scry / 2)
+        self.startx = round((scrx / 2) - (box_width / 2))
+        self.endx = self.startx + box_width
+        self.starty = round((scry / 2) - (box_height / 2))
+        self.endy = self.starty + box_height
+        self.create_window()
+        self.create_menu()
+
+    def create_menu(self):
+        max_length = self.endx - self.startx - 5
+        self.component = Menu(
+            self.window,
+            [truncate(self.describe(filepath), max_length) for filepath in self.results],
+            # Results start below the query line
+            2,
+            0,
+            self.endy - self.starty,
+            self.endx - self.startx,
+            self.component.active if self.component else False,
+        )
+        self.dirty = True
+
+    @staticmethod
+    def describe(filepath):
+        dirname, filename = os.path.split(filepath)
+        return f"{filename.split('.')[0]}  ({os.path.basename(dirname)})"
+
+    def clear(self):
+        self.cancel_search()
+        self.query = ""
+        self.results = []
+        self.create_menu()
+
+    def search(self):
+        self.cancel_search()
+        self.timer = Timer(SEARCH_DELAY, self.run_search, (self.query,))
+        self.timer.daemon = True
+        self.timer.start()
+
+    def cancel_search(self):
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+
+    def run_search(self, query):
+        conn = connect()
+        try:
+            results = search_media(conn.cursor(), query)
+        finally:
+            conn.close()
+        self.update_handler(partial(self.show_results, query, results))
+
+    def show_results(self, query, results):
+        if query != self.query:
+            # Typed on since, a newer search is on its way
+            return
+        self.results = results
+        self.create_menu()
+
+    def draw(self, status=None):
+        super().draw(status)
+        max_length = self.endx - self.startx - 5
+        self.window.addstr(2, 2, truncate("/ " + self.query, max_length))
+
+    def receive_input(self, key):
+        if key == curses.KEY_ENTER or key == '\n':
+            if self.results:
+                self.select_handler(self.results[self.component.selected])
+        elif key == ESCAPE_KEY:
+            self.cancel_search()
+            self.close_handler()
+        elif key in BACKSPACE_KEYS:
+            self.query = self.query[:-1]
+            self.search()
+        elif key in ('KEY_UP', 'KEY_DOWN'):
+            if self.results:
+                self.component.receive_input(key)
+        elif len(key) == 1 and key.isprintable():
+            self.query += key
+            self.search()
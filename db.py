@@ -1,15 +1,37 @@
 import logging
 import os
+import re
 import sqlite3
+from threading import Condition, Event, Thread
+from typing import Callable, List, NamedTuple
+
+from util import FLUSH_INTERVAL, SEARCH_CANDIDATES, SEARCH_LIMIT, SEARCH_MIN_CHARS
+
+DATABASE_PATH = "/tmp/vlc-tui/media.db"
+# Max number of bound variables per query on older SQLite versions
+MAX_QUERY_VARIABLES = 999
+
+
+def connect() -> sqlite3.Connection:
+    """
+    Open a new connection to the database in WAL mode, so readers never wait for the writer.
+    """
+    os.makedirs(os.path.dirname(DATABASE_PATH), exist_ok=True)
+    conn = sqlite3.connect(DATABASE_PATH)
+    conn.execute("PRAGMA journal_mode = WAL")
+    # In WAL mode NORMAL only syncs on checkpoints and still survives an application crash
+    conn.execute("PRAGMA synchronous = NORMAL")
+    return conn
 
 
 def init_database() -> sqlite3.Connection:
     """
     Initialize the database.
     """
-    conn = sqlite3.connect("/tmp/vlc-tui/media.db", check_same_thread=False)
+    conn = connect()
     cursor = conn.cursor()
     create_table(cursor)
+    migrate(cursor)
     conn.commit()
     return conn
 
@@ -34,36 +56,394 @@ def create_table(cursor: sqlite3.Cursor):
     )""")
 
 
-def get_media_details(cursor: sqlite3.Cursor, filepath: str) -> tuple | None:
+def _migrate_unique_filepath(cursor: sqlite3.Cursor):
+    """
+    Drop duplicate rows left by repeated inserts and make filepath unique.
+    The first row of each file is kept, as it is the one lookups used to return.
+    """
+    cursor.execute("""DELETE FROM media WHERE rowid NOT IN (
+        SELECT MIN(rowid) FROM media GROUP BY filepath
+    )""")
+    cursor.execute("""CREATE UNIQUE INDEX IF NOT EXISTS media_filepath ON media (filepath)""")
+
+
+def _migrate_fingerprint(cursor: sqlite3.Cursor):
+    """
+    Add the fingerprint of the probed file, so a replaced file is probed again:
+     size: file size in bytes
+     mtime: modification time in nanoseconds
+    A row with a fingerprint and no duration records a file that could not be probed.
+    """
+    cursor.execute("""ALTER TABLE media ADD COLUMN size INTEGER""")
+    cursor.execute("""ALTER TABLE media ADD COLUMN mtime INTEGER""")
+
+
+def _sql_dirname(column: str) -> str:
+    """SQL expression of the "<dir>/" part of a path: what is left after stripping non-slashes from the right"""
+    return f"rtrim({column}, replace({column}, '/', ''))"
+
+
+def _sql_title(column: str) -> str:
+    """SQL expression of the media title: the file name up to its first dot, as in `DirectoryItem`"""
+    basename = f"substr({column}, length({_sql_dirname(column)}) + 1)"
+    return f"substr({basename}, 1, instr({basename} || '.', '.') - 1)"
+
+
+def _migrate_search_index(cursor: sqlite3.Cursor):
+    """
+    Add a full-text index of media titles and directory path components, kept in sync by triggers.
+    """
+    try:
+        cursor.execute("""CREATE VIRTUAL TABLE media_fts USING fts5(title, path, prefix='2 3')""")
+    except sqlite3.OperationalError:
+        logging.warning("SQLite is built without FTS5, library search is disabled")
+        return
+
+    cursor.execute(f"""CREATE TRIGGER media_fts_insert AFTER INSERT ON media BEGIN
+        INSERT INTO media_fts (rowid, title, path)
+            VALUES (new.rowid, {_sql_title('new.filepath')}, {_sql_dirname('new.filepath')});
+    END""")
+    cursor.execute("""CREATE TRIGGER media_fts_delete AFTER DELETE ON media BEGIN
+        DELETE FROM media_fts WHERE rowid = old.rowid;
+    END""")
+    cursor.execute(f"""CREATE TRIGGER media_fts_update AFTER UPDATE OF filepath ON media BEGIN
+        UPDATE media_fts SET title = {_sql_title('new.filepath')}, path = {_sql_dirname('new.filepath')}
+            WHERE rowid = new.rowid;
+    END""")
+    cursor.execute(f"""INSERT INTO media_fts (rowid, title, path)
+        SELECT rowid, {_sql_title('filepath')}, {_sql_dirname('filepath')} FROM media""")
+
+
+def _migrate_played_at(cursor: sqlite3.Cursor):
+    """
+    Add the time a media file was last played, in seconds since the epoch, to sort by recently played.
+    """
+    cursor.execute("""ALTER TABLE media ADD COLUMN played_at INTEGER""")
+
+
+def _sql_rollup(row: str) -> dict:
+    """SQL expressions of what a media row counts for in the rollup of its directory"""
+    return {
+        'runtime': f"coalesce({row}.duration, 0)",
+        'watched': f"(coalesce({row}.was_played, 0) != 0)",
+        'in_progress': f"(coalesce({row}.was_played, 0) = 0 AND coalesce({row}.stoptime, 0) > 0)",
+    }
+
+
+def _sql_add_to_rollup(row: str) -> str:
+    rollup = _sql_rollup(row)
+    return f"""INSERT INTO directory_rollups (dirpath, media, runtime, watched, in_progress)
+            VALUES ({_sql_dirname(row + '.filepath')}, 1, {rollup['runtime']}, {rollup['watched']},
+                    {rollup['in_progress']})
+            ON CONFLICT (dirpath) DO UPDATE SET
+                media = media + 1, runtime = runtime + excluded.runtime,
+                watched = watched + excluded.watched, in_progress = in_progress + excluded.in_progress;"""
+
+
+def _sql_remove_from_rollup(row: str) -> str:
+    rollup = _sql_rollup(row)
+    return f"""UPDATE directory_rollups SET
+                media = media - 1, runtime = runtime - {rollup['runtime']},
+                watched = watched - {rollup['watched']}, in_progress = in_progress - {rollup['in_progress']}
+            WHERE dirpath = {_sql_dirname(row + '.filepath')};"""
+
+
+def _migrate_directory_rollups(cursor: sqlite3.Cursor):
+    """
+    Add the watch progress of each directory, kept up to date by triggers on every write to media:
+     dirpath: "<dir>/" of the counted media files
+     media: number of media files
+     runtime: sum of their durations
+     watched: number of played media files
+     in_progress: number of media files with a savepoint that were not played to the end
+    """
+    cursor.execute("""CREATE TABLE directory_rollups (
+        dirpath TEXT PRIMARY KEY,
+        media INTEGER,
+        runtime INTEGER,
+        watched INTEGER,
+        in_progress INTEGER
+    )""")
+    cursor.execute(f"""CREATE TRIGGER directory_rollups_insert AFTER INSERT ON media BEGIN
+        {_sql_add_to_rollup('new')}
+    END""")
+    cursor.execute(f"""CREATE TRIGGER directory_rollups_delete AFTER DELETE ON media BEGIN
+        {_sql_remove_from_rollup('old')}
+    END""")
+    # The old state is taken out of the counts and the new one added, also when the file moved
+    cursor.execute(f"""CREATE TRIGGER directory_rollups_update
+        AFTER UPDATE OF filepath, duration, stoptime, was_played ON media BEGIN
+        {_sql_remove_from_rollup('old')}
+        {_sql_add_to_rollup('new')}
+    END""")
+    rollup = _sql_rollup('media')
+    cursor.execute(f"""INSERT INTO directory_rollups (dirpath, media, runtime, watched, in_progress)
+        SELECT {_sql_dirname('filepath')}, count(*), sum({rollup['runtime']}), sum({rollup['watched']}),
+            sum({rollup['in_progress']})
+        FROM media GROUP BY 1""")
+
+
+# Schema migrations, applied in order. The schema version is kept in `PRAGMA user_version`
+# and equals the number of migrations applied.
+MIGRATIONS = [
+    _migrate_unique_filepath,
+    _migrate_fingerprint,
+    _migrate_search_index,
+    _migrate_played_at,
+    _migrate_directory_rollups,
+]
+
+
+def migrate(cursor: sqlite3.Cursor):
+    """
+    Apply all migrations newer than the database schema version.
+    """
+    version = cursor.execute("PRAGMA user_version").fetchone()[0]
+    for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+        logging.info(f"Migrating database to version {number}")
+        migration(cursor)
+        cursor.execute(f"PRAGMA user_version = {number}")
+
+
+def get_directory_media(cursor: sqlite3.Cursor, dirpath: str) -> dict:
+    """
+    Get the details of all media files directly inside a directory in a single query.
+    Returns a dict of filepath -> (duration, stoptime, was_played, size, mtime, played_at)
+    """
+    prefix = dirpath.rstrip('/') + '/'
+    # Every path inside the directory sorts between "<dir>/" and "<dir>0" ('0' follows '/'),
+    # so the lookup is a range scan over the filepath index. Nested files are filtered out.
+    cursor.execute("""SELECT filepath, duration, stoptime, was_played, size, mtime, played_at FROM media
+        WHERE filepath > ? AND filepath < ? AND instr(substr(filepath, ?), '/') = 0""",
+        (prefix, prefix[:-1] + '0', len(prefix) + 1))
+    return {row[0]: row[1:] for row in cursor.fetchall()}
+
+
+def get_media_by_paths(cursor: sqlite3.Cursor, filepaths: List[str]) -> dict:
+    """
+    Get the details of the given media files, in as few queries as the SQLite variable limit allows.
+    Returns a dict of filepath -> (duration, stoptime, was_played, size, mtime, played_at)
+    """
+    details = {}
+    for start in range(0, len(filepaths), MAX_QUERY_VARIABLES):
+        batch = filepaths[start:start + MAX_QUERY_VARIABLES]
+        cursor.execute(f"""SELECT filepath, duration, stoptime, was_played, size, mtime, played_at FROM media
+            WHERE filepath IN ({', '.join('?' * len(batch))})""", batch)
+        details.update((row[0], row[1:]) for row in cursor.fetchall())
+    return details
+
+
+class DirectoryRollup(NamedTuple):
+    """Watch progress of the media files in a directory tree"""
+    media: int
+    runtime: int
+    watched: int
+    in_progress: int
+
+
+def get_directory_rollups(cursor: sqlite3.Cursor, dirpath: str) -> dict:
+    """
+    Get the watch progress of each subdirectory of a directory, including nested directories,
+    from the rollups in a single range scan.
+    Returns a dict of subdirectory name -> `DirectoryRollup`
+    """
+    prefix = dirpath.rstrip('/') + '/'
+    cursor.execute("""SELECT dirpath, media, runtime, watched, in_progress FROM directory_rollups
+        WHERE dirpath > ? AND dirpath < ?""", (prefix, prefix[:-1] + '0'))
+    totals = {}
+    for path, *counts in cursor.fetchall():
+        name = path[len(prefix):].split('/', 1)[0]
+        total = totals.get(name, (0, 0, 0, 0))
+        totals[name] = tuple(a + b for a, b in zip(total, counts))
+    return {name: DirectoryRollup(*total) for name, total in totals.items()}
+
+
+def search_media(cursor: sqlite3.Cursor, query: str, limit: int = SEARCH_LIMIT) -> List[str]:
     """
-    Get the details of a media file from the database.
-    Returns a tuple of (duration, stoptime, was_played)
+    Search the library for media whose title or directory matches every word of the query as a prefix.
+    Words shorter than `SEARCH_MIN_CHARS` are ignored.
+    Returns file paths, best matches (title hits first) first. Only the first `SEARCH_CANDIDATES`
+    matches are ranked, so a common word doesn't rank the whole library.
     """
-    cursor.execute("""SELECT duration, stoptime, was_played FROM media WHERE filepath = ?""", (filepath,))
-    media = cursor.fetchone()
-    if not media:
-        return None
-    return (media[0], media[1], media[2])
+    words = [word for word in re.findall(r"\w+", query) if len(word) >= SEARCH_MIN_CHARS]
+    if not words:
+        return []
+    match = " ".join(f'"{word}"*' for word in words)
+    try:
+        cursor.execute("""SELECT media.filepath FROM (
+                SELECT rowid, bm25(media_fts, 10.0, 1.0) AS score FROM media_fts
+                WHERE media_fts MATCH ?
+                LIMIT ?
+            ) AS hits
+            JOIN media ON media.rowid = hits.rowid
+            ORDER BY hits.score
+            LIMIT ?""", (match, SEARCH_CANDIDATES, limit))
+    except sqlite3.OperationalError:
+        logging.exception("Library search failed")
+        return []
+    return [row[0] for row in cursor.fetchall()]
 
 
-def insert_media(cursor: sqlite3.Cursor, filepath: str, duration: int, stoptime: int = None, was_played: bool = False):
+def upsert_media(cursor: sqlite3.Cursor, filepath: str, duration: int | None, size: int, mtime: int,
+                 stoptime: int = None, was_played: bool = False):
     """
-    Insert a new media file into the database.
+    Insert a new media file into the database. If the file is already known, only its duration and
+    fingerprint are updated. A duration of None marks a file that could not be probed.
     """
-    if not filepath or not duration:
-        raise ValueError("filepath and duration are required")
+    if not filepath or size is None or mtime is None:
+        raise ValueError("filepath, size and mtime are required")
 
-    cursor.execute("""INSERT INTO media (filepath, duration, stoptime, was_played)
-        VALUES (?, ?, ?, ?)""", (filepath, duration, stoptime, was_played))
-    logging.debug(f"Inserted media file: {filepath}")
+    cursor.execute("""INSERT INTO media (filepath, duration, stoptime, was_played, size, mtime)
+        VALUES (?, ?, ?, ?, ?, ?)
+        ON CONFLICT (filepath) DO UPDATE SET
+            duration = excluded.duration, size = excluded.size, mtime = excluded.mtime""",
+        (filepath, duration, stoptime, was_played, size, mtime))
+    logging.debug(f"Upserted media file: {filepath}")
 
 
-def update_media(cursor: sqlite3.Cursor, filepath: str, *, stoptime: int = None, was_played: bool = False):
+def update_media(cursor: sqlite3.Cursor, filepath: str, *, stoptime: int = None, was_played: bool = False,
+                 played_at: int = None):
     """
     Update a media file in the database. If was_played is True, then reset stoptime to 0.
+    The last played time is kept unless `played_at` is given.
+    Does not commit: the caller owns the transaction.
     """
     new_stoptime = 0 if was_played else stoptime
     logging.debug(f"Updating media file: {filepath} (stoptime: {new_stoptime})")
-    cursor.execute("""UPDATE media SET stoptime = ?
-        WHERE filepath = ?""", (new_stoptime, filepath))
-    cursor.connection.commit()
+    cursor.execute("""UPDATE media SET stoptime = ?, was_played = ?, played_at = coalesce(?, played_at)
+        WHERE filepath = ?""", (new_stoptime, was_played, played_at, filepath))
+
+
+class MediaWriter(Thread):
+    """
+    Owns the only write connection to the database.
+
+    Writes are queued in memory, keeping only the latest state per file, and flushed in a single
+    transaction `interval` seconds after the first of them was queued, or whenever `flush` is called.
+    The thread sleeps without waking up while nothing is queued. Readers that must see the writes
+    without waiting for them use `read_through`.
+    """
+
+    def __init__(self, interval: float = FLUSH_INTERVAL):
+        super().__init__(name="media-writer", daemon=True)
+        self.interval = interval
+        self._cond = Condition()
+        self._wakeup = Event()
+        self._inserts = {}  # filepath -> (duration, size, mtime)
+        self._updates = {}  # filepath -> (stoptime, was_played, played_at)
+        # Inserts and updates taken from the queue and not committed yet
+        self._writing = ({}, {})
+        # (flush number, callback) to call once that flush is committed
+        self._callbacks = []
+        self._requested = 0
+        self._completed = 0
+        self._closed = False
+
+    def upsert_media(self, filepath: str, duration: int | None, size: int, mtime: int):
+        with self._cond:
+            self._inserts[filepath] = (duration, size, mtime)
+            self._cond.notify_all()
+
+    def update_media(self, filepath: str, *, stoptime: int = None, was_played: bool = False,
+                     played_at: int = None):
+        with self._cond:
+            self._updates[filepath] = (stoptime, was_played, played_at)
+            self._cond.notify_all()
+
+    def _has_work(self) -> bool:
+        return bool(self._inserts or self._updates) or self._requested > self._completed or self._closed
+
+    def flush(self, wait: bool = True, callback: Callable[[], None] = None):
+        """
+        Write everything queued so far. If `wait` is True, block until it is committed.
+        `callback` is called on the writer thread once it is committed.
+        """
+        with self._cond:
+            self._requested += 1
+            target = self._requested
+            if callback:
+                self._callbacks.append((target, callback))
+            self._cond.notify_all()
+        self._wakeup.set()
+        if wait:
+            with self._cond:
+                self._cond.wait_for(lambda: self._completed >= target or not self.is_alive())
+
+    def read_through(self, read: Callable[[], dict], filepaths: List[str]) -> dict:
+        """
+        Returns `read()`, saved details as returned by `get_media_by_paths`, with the writes of `filepaths`
+        that are not committed yet applied to them. Writes are looked up before reading, so a write
+        committed in between is not missed.
+        """
+        wanted = set(filepaths)
+        pending = []
+        with self._cond:
+            for inserts, updates in (self._writing, (self._inserts, self._updates)):
+                pending.extend(('insert', path, values) for path, values in inserts.items() if path in wanted)
+                pending.extend(('update', path, values) for path, values in updates.items() if path in wanted)
+        details = read()
+        # Same as `upsert_media` and `update_media`
+        for kind, path, values in pending:
+            row = details.get(path)
+            if kind == 'insert':
+                duration, size, mtime = values
+                details[path] = (duration, row[1], row[2], size, mtime, row[5]) if row else \
+                    (duration, None, False, size, mtime, None)
+            elif row:
+                stoptime, was_played, played_at = values
+                details[path] = (row[0], 0 if was_played else stoptime, was_played, row[3], row[4],
+                                 row[5] if played_at is None else played_at)
+        return details
+
+    def close(self):
+        """
+        Flush pending writes and stop the writer thread.
+        """
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._wakeup.set()
+        self.join()
+
+    def run(self):
+        conn = connect()
+        while True:
+            with self._cond:
+                self._cond.wait_for(self._has_work)
+            # Collect more writes for `interval` seconds, unless a flush is requested
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            with self._cond:
+                inserts, self._inserts = self._inserts, {}
+                updates, self._updates = self._updates, {}
+                self._writing = (inserts, updates)
+                target = self._requested
+                closed = self._closed
+
+            if inserts or updates:
+                try:
+                    self._write(conn, inserts, updates)
+                except sqlite3.Error:
+                    logging.exception("Failed to write media updates")
+
+            with self._cond:
+                self._writing = ({}, {})
+                self._completed = target
+                callbacks = [callback for number, callback in self._callbacks if number <= target]
+                self._callbacks = [(number, callback) for number, callback in self._callbacks
+                                   if number > target]
+                self._cond.notify_all()
+            for callback in callbacks:
+                callback()
+            if closed:
+                break
+        conn.close()
+
+    def _write(self, conn: sqlite3.Connection, inserts: dict, updates: dict):
+        logging.debug(f"Flushing {len(inserts)} inserts and {len(updates)} updates")
+        with conn:
+            cursor = conn.cursor()
+            for filepath, (duration, size, mtime) in inserts.items():
+                upsert_media(cursor, filepath, duration, size, mtime)
+            for filepath, (stoptime, was_played, played_at) in updates.items():
+                update_media(cursor, filepath, stoptime=stoptime, was_played=was_played, played_at=played_at)
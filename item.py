@@ -1,44 +1,398 @@
 import logging
 import os
-from typing import Generator, List
+import re
+import sys
+import time
+from array import array
+from bisect import bisect
+from dataclasses import dataclass
+from functools import partial
+from threading import Lock
+from typing import List
 
-from db import get_media_details, insert_media, update_media
-from util import (SUPPORTED_EXTS, TRIGGER_WAS_PLAYED, get_media_length,
-                  ms_to_hms)
+from db import get_media_by_paths
+from util import SCAN_CHUNK, SORT_MODE, TRIGGER_WAS_PLAYED, is_supported, ms_to_hms
 
+# Row flags of `ItemStore`
+IS_MEDIA = 1
+WAS_PLAYED = 2
+NEEDS_PROBE = 4
+REMOVED = 8
 
-class DirectoryItem:
+# Stored in place of a missing duration or fingerprint
+UNKNOWN = -1
+
+NUMBERS = re.compile(r'(\d+)')
+
+
+class ItemStore:
+    """
+    Columnar storage of the items of one directory listing.
+
+    The directory path is kept once, titles are interned, and numbers live in typed arrays.
+    `DirectoryItem`s are only created on demand, as views of a single row.
+
+    Rows are only ever appended, so a row number identifies an item for the lifetime of the store.
+    `order` holds the rows of the listing in display order; the store is a sequence of items in
+    that order. The natural sort key of each title is computed once, when its row is added, so
+    changing the sort mode only re-sorts `order`.
+    """
+
+    def __init__(self, writer, dirpath):
+        self.writer = writer
+        self.dirpath = dirpath
+        self.names = []
+        self.titles = []
+        self.keys = []
+        self.flags = bytearray()
+        self.durations = array('q')
+        self.stoptimes = array('q')
+        self.sizes = array('q')
+        self.mtimes = array('q')
+        self.played_at = array('q')
+        self.order = array('l')
+        self.sort_mode = SORT_MODE
+        self.rows = RowsView(self)
+        # Formatted rows: row -> (cells, line), line is None until formatted for `widths`
+        self.rendered = {}
+        self.widths = None
+        # Case-folded titles, built when the listing is first filtered
+        self.folded = []
+        # Watch progress of the subdirectories by name, see `set_rollups`
+        self.rollups = {}
+
+    def __len__(self):
+        return len(self.order)
+
+    def __getitem__(self, idx) -> 'DirectoryItem':
+        return DirectoryItem(self, self.order[idx])
 
-    __slots__ = ('cursor', 'filepath', 'is_media', 'title', 'duration', 'stoptime', 'was_played')
+    def __delitem__(self, idx):
+        self.flags[self.order[idx]] |= REMOVED
+        self.invalidate(self.order[idx])
+        del self.order[idx]
 
-    def __init__(self, cursor, filepath):
-        self.filepath = filepath
-        self.cursor = cursor
+    def index(self, item: 'DirectoryItem') -> int:
+        return self.order.index(item.row)
 
-        if os.path.isdir(filepath):
-            self.is_media = False
-            self.title = os.path.basename(self.filepath)
+    def find(self, name) -> int | None:
+        """
+        Returns the position of the listed entry with the given name, or None.
+        """
+        row = -1
+        while True:
+            try:
+                row = self.names.index(name, row + 1)
+            except ValueError:
+                return None
+            if not self.flags[row] & REMOVED:
+                return self.order.index(row)
+
+    def add(self, name, details: dict | None = None, *, is_dir: bool = None,
+            stat: os.stat_result = None, key: str = None) -> 'DirectoryItem':
+        """
+        Add a row for a directory entry, without listing it. Returns the new item.
+        `details` is a dict of filepath -> saved state, as returned by `get_media_by_paths`.
+        Media without a valid cached duration is left with `needs_probe` set, see `probe.Prober`.
+        `is_dir`, `stat` and the natural sort `key` are computed here unless the caller already knows them.
+        """
+        filepath = os.path.join(self.dirpath, name)
+        if is_dir is None:
+            is_dir = os.path.isdir(filepath)
+        if not is_dir and not is_supported(name):
+            raise ValueError(f'Unsupported file type: {filepath}')
+
+        flags = 0
+        duration = size = mtime = UNKNOWN
+        stoptime = played_at = 0
+        if not is_dir:
             # For directories, we don't need to fill anything else.
-            return None
-        elif not os.path.splitext(self.filepath)[1] in SUPPORTED_EXTS:
-            logging.debug(os.path.splitext(self.filepath))
-            raise ValueError(f'Unsupported file type: {self.filepath}')
-
-        self.is_media = True
-        self.title = os.path.basename(self.filepath).split('.')[0]
-
-        details = get_media_details(self.cursor, self.filepath)
-        if details:
-            self.duration = details[0]
-            self.stoptime = details[1]
-            self.was_played = details[2]
+            flags |= IS_MEDIA
+            stat = stat or os.stat(filepath)
+            size, mtime = stat.st_size, stat.st_mtime_ns
+            details = details.get(filepath) if details else None
+            if details and details[3:5] == (size, mtime):
+                # File is unchanged since it was probed. A missing duration means probing it failed.
+                duration = UNKNOWN if details[0] is None else details[0]
+            elif details and details[3] is None and details[0]:
+                # Saved before fingerprints were stored: trust the duration and record the fingerprint.
+                duration = details[0]
+                self.writer.upsert_media(filepath, duration, size, mtime)
+            else:
+                # Media not in the database or replaced since. The duration has to be probed from the file.
+                logging.debug(f'No details found for {filepath}')
+                flags |= NEEDS_PROBE
+            if details:
+                stoptime = details[1] or 0
+                flags |= WAS_PLAYED if details[2] else 0
+                played_at = details[5] or 0
+
+        title = sys.intern(make_title(name, is_dir))
+        self.names.append(name)
+        self.titles.append(title)
+        self.keys.append(natural_key(title) if key is None else key)
+        self.flags.append(flags)
+        self.durations.append(int(duration))
+        self.stoptimes.append(stoptime)
+        self.sizes.append(size)
+        self.mtimes.append(mtime)
+        self.played_at.append(played_at)
+        return DirectoryItem(self, len(self.names) - 1)
+
+    def append(self, name, details: dict | None = None, **kwargs) -> 'DirectoryItem':
+        """
+        Add a row for a directory entry at the end of the listing.
+        """
+        item = self.add(name, details, **kwargs)
+        self.order.append(item.row)
+        return item
+
+    def add_entry(self, entry: os.DirEntry, details: dict | None = None, key: str = None) -> 'DirectoryItem':
+        """
+        Append a directory entry of `os.scandir`, reusing its file type and cached stat.
+        """
+        if entry.is_dir():
+            return self.append(entry.name, is_dir=True, key=key)
+        return self.append(entry.name, details, is_dir=False, stat=entry.stat(), key=key)
+
+    def insert_sorted(self, item: 'DirectoryItem') -> int:
+        """
+        List a row added with `add` at its sorted position. Returns the position.
+        """
+        idx = bisect(self.order, self.sort_key(item.row), key=self.sort_key)
+        self.order.insert(idx, item.row)
+        return idx
+
+    def sort_key(self, row: int) -> tuple:
+        """
+        Position of a row in the current sort mode: the parent directory first, then directories by
+        name, then media files. Ties are broken by name.
+        """
+        if not self.flags[row] & IS_MEDIA:
+            return (0 if self.names[row] == '..' else 1, self.keys[row])
+        mode = self.sort_mode
+        if mode == 'duration':
+            # Unknown durations last
+            duration = self.durations[row]
+            return (2, duration == UNKNOWN, duration, self.keys[row])
+        if mode == 'unwatched':
+            return (2, bool(self.flags[row] & WAS_PLAYED), self.keys[row])
+        if mode == 'in_progress':
+            in_progress = self.stoptimes[row] > 0 and not self.flags[row] & WAS_PLAYED
+            return (2, not in_progress, self.keys[row])
+        if mode == 'recent':
+            return (2, -self.played_at[row], self.keys[row])
+        return (2, self.keys[row])
+
+    def folded_titles(self) -> List[str]:
+        """
+        Returns the case-folded titles of all rows, the index of `ListingFilter`.
+        Only rows added since the last call are folded.
+        """
+        self.folded.extend(title.casefold() for title in self.titles[len(self.folded):])
+        return self.folded
+
+    def invalidate(self, row: int):
+        """
+        Drop the formatted row after its watch state or duration changed.
+        """
+        self.rendered.pop(row, None)
+
+    def set_rollups(self, rollups: dict):
+        """
+        Show the watch progress of the subdirectories, as returned by `db.get_directory_rollups`.
+        """
+        if rollups == self.rollups:
+            return
+        self.rollups = rollups
+        for row in [row for row in self.rendered if not self.flags[row] & IS_MEDIA]:
+            self.invalidate(row)
+
+    def sort(self, mode: str):
+        """
+        Re-sort the listing in the given mode, from the cached keys.
+        """
+        self.sort_mode = mode
+        self.order = array('l', sorted(self.order, key=self.sort_key))
+
+
+class ListingFilter:
+    """
+    Rows of a listing whose titles fuzzy match a query: its characters appear in the title in order.
+
+    Every character typed only narrows the matches of the previous query, and the matches of each
+    shorter query are kept, so deleting a character needs no search at all.
+    Like `ItemStore`, it is a sequence of items in display order.
+    """
+
+    def __init__(self, store: ItemStore, origin: int | None = None):
+        self.store = store
+        # Row selected before filtering, selected again when the filter is cleared
+        self.origin = origin
+        self.query = ''
+        self.matches = [store.order]
+        self.selected = 0
+        self.scroll_start = 0
+        self.rows = RowsView(store, self)
+
+    @property
+    def order(self):
+        return self.matches[-1]
+
+    def __len__(self):
+        return len(self.order)
+
+    def __getitem__(self, idx) -> 'DirectoryItem':
+        return DirectoryItem(self.store, self.order[idx])
+
+    def narrow(self, query: str):
+        """
+        Extend the query by its last characters and keep only the rows still matching.
+        """
+        pattern = re.compile('.*?'.join(re.escape(char) for char in query.casefold()))
+        titles = self.store.folded_titles()
+        search = pattern.search
+        self.query = query
+        self.matches.append(array('l', (row for row in self.order if search(titles[row]))))
+
+    def widen(self):
+        """
+        Drop the last character of the query.
+        """
+        if len(self.matches) > 1:
+            self.matches.pop()
+            self.query = self.query[:-1]
+
+    def refresh(self):
+        """
+        Search again after rows of the listing were added, removed or re-sorted.
+        """
+        query = self.query
+        self.query = ''
+        self.matches = [self.store.order]
+        for end in range(1, len(query) + 1):
+            self.narrow(query[:end])
+
+
+class RowsView:
+    """
+    Table rows of a store's listing, or of the rows of a `ListingFilter`. Rows are formatted on first
+    access and cached in the store until the item changes, see `ItemStore.invalidate`.
+    """
+
+    def __init__(self, store: ItemStore, source=None):
+        self.store = store
+        # Provides the rows in display order
+        self.source = store if source is None else source
+
+    def __len__(self):
+        return len(self.source.order)
+
+    def __getitem__(self, idx):
+        return self._rendered(self.source.order[idx])[0]
+
+    def _rendered(self, row: int) -> tuple:
+        rendered = self.store.rendered.get(row)
+        if rendered is None:
+            rendered = self.store.rendered[row] = (DirectoryItem(self.store, row).as_row(), None)
+        return rendered
+
+    def formatted(self, idx, menu) -> str:
+        """
+        Returns the row at `idx` as formatted by the table menu, formatting it only if it changed.
+        """
+        store = self.store
+        if store.widths != menu.widths:
+            # Column widths changed, every line has to be formatted again
+            store.rendered = {row: (cells, None) for row, (cells, _) in store.rendered.items()}
+            store.widths = menu.widths
+        row = self.source.order[idx]
+        cells, line = self._rendered(row)
+        if line is None:
+            line = menu.render_table_row(cells)
+            store.rendered[row] = (cells, line)
+        return line
+
+
+class DirectoryItem:
+    """
+    View of one row of an `ItemStore`.
+    """
+
+    __slots__ = ('store', 'row')
+
+    def __init__(self, store: ItemStore, row: int):
+        self.store = store
+        self.row = row
+
+    def __eq__(self, other):
+        return isinstance(other, DirectoryItem) and self.store is other.store and self.row == other.row
+
+    def __hash__(self):
+        return hash((id(self.store), self.row))
+
+    @property
+    def writer(self):
+        return self.store.writer
+
+    @property
+    def filepath(self):
+        return os.path.join(self.store.dirpath, self.store.names[self.row])
+
+    @property
+    def title(self):
+        return self.store.titles[self.row]
+
+    @property
+    def is_media(self):
+        return bool(self.store.flags[self.row] & IS_MEDIA)
+
+    @property
+    def needs_probe(self):
+        return bool(self.store.flags[self.row] & NEEDS_PROBE)
+
+    @property
+    def fingerprint(self):
+        return (self.store.sizes[self.row], self.store.mtimes[self.row])
+
+    @property
+    def duration(self):
+        duration = self.store.durations[self.row]
+        return None if duration == UNKNOWN else duration
+
+    @property
+    def stoptime(self):
+        return self.store.stoptimes[self.row]
+
+    @stoptime.setter
+    def stoptime(self, stoptime):
+        self.store.stoptimes[self.row] = int(stoptime)
+        self.store.invalidate(self.row)
+
+    @property
+    def played_at(self):
+        return self.store.played_at[self.row]
+
+    @property
+    def was_played(self):
+        return bool(self.store.flags[self.row] & WAS_PLAYED)
+
+    @was_played.setter
+    def was_played(self, was_played):
+        if was_played:
+            self.store.flags[self.row] |= WAS_PLAYED
         else:
-            # Media not in the database. Get the duration from the file and insert media.
-            logging.debug(f'No details found for {self.filepath}')
-            self.duration = get_media_length(self.filepath)
-            self.stoptime = 0
-            self.was_played = False
-            insert_media(self.cursor, self.filepath, self.duration)    
+            self.store.flags[self.row] &= ~WAS_PLAYED
+        self.store.invalidate(self.row)
+
+    def set_duration(self, duration):
+        """
+        Store the probed duration (None if probing failed) for the current fingerprint.
+        """
+        self.store.durations[self.row] = UNKNOWN if duration is None else int(duration)
+        self.store.flags[self.row] &= ~NEEDS_PROBE
+        self.store.invalidate(self.row)
+        self.writer.upsert_media(self.filepath, duration, *self.fingerprint)
 
     def __repr__(self):
         base = f'<{self.filepath} ({self.is_media})>'
@@ -46,41 +400,179 @@ class DirectoryItem:
             return base + f' ({self.was_played}, {self.stoptime}, {self.duration})'
         return base
 
+    @property
+    def rollup(self):
+        """
+        Watch progress of a directory's media, or None if none of it was ever listed
+        """
+        if self.is_media:
+            return None
+        rollup = self.store.rollups.get(self.store.names[self.row])
+        return rollup if rollup and rollup.media else None
+
     @property
     def status_icon(self):
         if self.is_media and self.was_played:
             return '✓' 
         elif self.is_media and self.stoptime:
             return '❚❚'
+        elif not self.is_media and self.rollup:
+            # All of the directory watched, or some of it
+            rollup = self.rollup
+            if rollup.watched == rollup.media:
+                return '✓'
+            return '❚❚' if rollup.watched or rollup.in_progress else ''
         else:
             return ''
 
+    @property
+    def duration_label(self):
+        if not self.is_media:
+            rollup = self.rollup
+            return ms_to_hms(rollup.runtime) if rollup and rollup.runtime else ''
+        if self.needs_probe:
+            # Placeholder until the duration is probed in the background
+            return '…'
+        return ms_to_hms(self.duration) if self.duration else ''
+
     def make_savepoint(self, stoptime):
         if not self.is_media or self.was_played:
             return
 
-        if self.duration - stoptime < TRIGGER_WAS_PLAYED * 1_000:
+        played_at = self.store.played_at[self.row] = int(time.time())
+        if self.duration and self.duration - stoptime < TRIGGER_WAS_PLAYED * 1_000:
             self.was_played = True
-            update_media(self.cursor, self.filepath, was_played=True)
+            self.writer.update_media(self.filepath, was_played=True, played_at=played_at)
         else:
             self.stoptime = stoptime
-            update_media(self.cursor, self.filepath, stoptime=stoptime)
+            self.writer.update_media(self.filepath, stoptime=stoptime, played_at=played_at)
 
-    def as_row(self):        
-        logging.debug(repr(self))
+    def as_row(self):
+        rollup = self.rollup
         return [
             self.status_icon,
-            self.title,
-            ms_to_hms(self.duration) if self.is_media and self.duration else '',
+            f'{self.title}  {rollup.watched}/{rollup.media}' if rollup else self.title,
+            self.duration_label,
         ]
 
 
-def sort_items(items: List[DirectoryItem]) -> Generator[DirectoryItem, None, None]:
+def make_title(name, is_dir) -> str:
     """
-    Sort the items in the list by title. Directories are sorted first, then media files.
+    Title of a listed entry: the full name of a directory, the name up to the first dot of a media file.
     """
-    dirs = filter(lambda item: not item.is_media, items)
-    yield from sorted(dirs, key=lambda item: item.title)
+    return name if is_dir else name.split('.')[0]
 
-    files = filter(lambda item: item.is_media, items)
-    yield from sorted(files, key=lambda item: item.title)
+
+def natural_key(title: str) -> str:
+    """
+    Case-insensitive sort key of a title that compares numbers by value, so "Episode 2" comes before
+    "Episode 10". Numbers are written without leading zeros after their two-digit length, which keeps
+    the key a single string, the cheapest to cache per row.
+    """
+    return NUMBERS.sub(_number_key, title.casefold())
+
+
+def _number_key(match: re.Match) -> str:
+    digits = str(int(match.group()))
+    return f'{len(digits):02d}{digits}'
+
+
+class DirectoryListing:
+    """
+    Sorted listing of a directory, created in chunks.
+
+    All entries are read and sorted up front, which needs no stat calls. Items, which need a stat and
+    the saved state, are created `SCAN_CHUNK` at a time, so the first screen of a large directory can
+    be shown before the rest is loaded. `items`, an `ItemStore`, only ever grows at the end.
+    Chunks may be loaded from several threads, one chunk at a time.
+    """
+
+    def __init__(self, writer, dirpath):
+        logging.info(f'Scanning directory: {dirpath}')
+        self.writer = writer
+        self.dirpath = dirpath
+        self.items = ItemStore(writer, dirpath)
+        self.position = 0
+        self.cancelled = False
+        self.lock = Lock()
+
+        # Entries are ((is media, natural key), DirEntry), sorted by name.
+        # The parent directory has no DirEntry and comes first.
+        self.entries = []
+        if dirpath != '/':
+            self.entries.append(((False, ''), None))
+        # File types come from the directory listing itself
+        with os.scandir(dirpath) as entries:
+            for entry in entries:
+                if entry.name.startswith('.'):
+                    continue
+                is_dir = entry.is_dir()
+                if not is_dir and not is_supported(entry.name):
+                    continue
+                self.entries.append(((not is_dir, natural_key(make_title(entry.name, is_dir))), entry))
+        self.entries.sort(key=lambda entry: entry[0])
+
+
+    @property
+    def loaded(self) -> bool:
+        return self.position >= len(self.entries)
+
+    def load_chunk(self, cursor, size: int = SCAN_CHUNK) -> List[DirectoryItem]:
+        """
+        Create the items of the next chunk of entries and return them.
+        Only media files are stat'ed, and their saved state is fetched in one query.
+        """
+        with self.lock:
+            chunk = self.entries[self.position:self.position + size]
+            paths = [entry.path for _, entry in chunk if entry and not entry.is_dir()]
+            # Including savepoints that are not written yet
+            details = self.writer.read_through(partial(get_media_by_paths, cursor, paths), paths)
+            items = []
+            for (_, key), entry in chunk:
+                if entry is None:
+                    items.append(self.items.append('..', is_dir=True))
+                    continue
+                try:
+                    items.append(self.items.add_entry(entry, details, key))
+                except FileNotFoundError:
+                    # Removed since the directory was read
+                    continue
+
+            self.position += len(chunk)
+            return items
+
+    def load_until(self, cursor, count: int) -> List[DirectoryItem]:
+        """
+        Load chunks until at least `count` items are available, or all of them. Returns the new items.
+        """
+        items = []
+        while len(self.items) < count and not self.loaded and not self.cancelled:
+            items.extend(self.load_chunk(cursor))
+        return items
+
+    def load_all(self, cursor):
+        self.load_until(cursor, len(self.entries))
+
+
+def scan_directory(cursor, writer, dirpath) -> ItemStore:
+    """
+    List the whole directory as sorted items. Media without a valid cached duration needs probing afterwards.
+    """
+    listing = DirectoryListing(writer, dirpath)
+    listing.load_all(cursor)
+    return listing.items
+
+
+@dataclass
+class DirectoryView:
+    """Scanned listing of a directory and the menu position in it"""
+    items: ItemStore
+    mtime: int
+    selected: int = 0
+    scroll_start: int = 0
+    # Set while the listing is still being loaded in chunks
+    listing: DirectoryListing = None
+
+    @property
+    def loaded(self) -> bool:
+        return self.listing is None or self.listing.loaded
@@ -1,13 +1,24 @@
+import time
+
+# Start of the startup profile, before the imports below
+STARTED = time.perf_counter()
+
 import argparse
 import curses
 import os
+import signal
+import sys
 from contextlib import contextmanager, redirect_stderr, redirect_stdout
-from email import parser
 from functools import partial
 
-from db import init_database
+from db import MediaWriter, init_database
 from main_form import MainForm
-from util import SUPPORTED_EXTS
+from prefetch import Prefetcher
+from probe import Prober
+from startup import StartupProfile
+from util import (FLUSH_INTERVAL, MAX_FPS, PREFETCH_DELAY, PREFETCH_WORKERS,
+                  PROBE_BACKEND, PROBE_BACKENDS, PROBE_WORKERS, REPEAT_MODE, REPEAT_MODES,
+                  SORT_MODE, SORT_MODES, SUPPORTED_EXTS)
 
 
 @contextmanager
@@ -42,9 +53,12 @@ def init_colors():
 
 
 class App:
-    def __init__(self, stdscr, filepath, cursor):
+    def __init__(self, stdscr, filepath, cursor, writer, prober, prefetcher, sort_mode, max_fps,
+                 repeat, shuffle, profile, curses_start):
         init_colors()
-        self.main_form = MainForm(stdscr, filepath, cursor)
+        profile.record('curses', curses_start)
+        self.main_form = MainForm(stdscr, filepath, cursor, writer, prober, prefetcher, sort_mode, max_fps,
+                                  repeat, shuffle, profile)
 
 
 def validate_filepath(filepath):
@@ -61,11 +75,59 @@ def validate_filepath(filepath):
     return filepath
 
 
+def handle_sigterm(signum, frame):
+    # Unwind through curses.wrapper so the terminal is restored and pending savepoints are flushed
+    sys.exit(0)
+
+
 if __name__ == "__main__":
+    profile = StartupProfile(STARTED)
+    profile.record('imports', STARTED)
+
     parser = argparse.ArgumentParser(description="VLC Terminal Player")
     parser.add_argument(
         "player_path", type=str, help="Path to directory or file to play"
     )
+    parser.add_argument(
+        "--flush-interval", type=float, default=FLUSH_INTERVAL,
+        help="Seconds between writes of playback positions to the database"
+    )
+    parser.add_argument(
+        "--probe-workers", type=int, default=PROBE_WORKERS,
+        help="Number of media files probed in parallel while scanning a directory"
+    )
+    parser.add_argument(
+        "--probe-backend", choices=PROBE_BACKENDS, default=PROBE_BACKEND,
+        help="How media durations are read"
+    )
+    parser.add_argument(
+        "--prefetch-delay", type=float, default=PREFETCH_DELAY,
+        help="Seconds the selection rests on a directory before it is scanned in the background"
+    )
+    parser.add_argument(
+        "--prefetch-workers", type=int, default=PREFETCH_WORKERS,
+        help="Number of directories prefetched at the same time"
+    )
+    parser.add_argument(
+        "--sort", choices=SORT_MODES, default=SORT_MODE,
+        help="Initial order of directory listings, changed with S"
+    )
+    parser.add_argument(
+        "--max-fps", type=float, default=MAX_FPS,
+        help="Max screen updates per second"
+    )
+    parser.add_argument(
+        "--repeat", choices=REPEAT_MODES, default=REPEAT_MODE,
+        help="Initial repeat mode of the playlist, changed with R"
+    )
+    parser.add_argument(
+        "--shuffle", action="store_true",
+        help="Play the tracks of a directory in random order, toggled with Z"
+    )
+    parser.add_argument(
+        "--profile-startup", action="store_true",
+        help="Print how long each phase of startup took on exit"
+    )
     args = parser.parse_args()
 
     validate_filepath(args.player_path)
@@ -73,9 +135,26 @@ if __name__ == "__main__":
     os.environ["VLC_VERBOSE"] = "-1"
     os.environ["XDG_RUNTIME_DIR"] = "/run/user/1000"
 
-    conn = init_database()
+    with profile.phase('database'):
+        conn = init_database()
+    with profile.phase('workers'):
+        writer = MediaWriter(args.flush_interval)
+        writer.start()
+        prober = Prober(args.probe_workers, args.probe_backend)
+        prefetcher = Prefetcher(writer, args.prefetch_workers, args.prefetch_delay)
+    signal.signal(signal.SIGTERM, handle_sigterm)
 
-    app_partial = partial(App, filepath=args.player_path, cursor=conn.cursor())
-    with supress_stdout_stderr():
-        curses.wrapper(app_partial)
-    conn.close()
+    app_partial = partial(App, filepath=args.player_path, cursor=conn.cursor(), writer=writer,
+                          prober=prober, prefetcher=prefetcher, sort_mode=args.sort, max_fps=args.max_fps,
+                          repeat=args.repeat, shuffle=args.shuffle, profile=profile,
+                          curses_start=time.perf_counter())
+    try:
+        with supress_stdout_stderr():
+            curses.wrapper(app_partial)
+    finally:
+        prefetcher.shutdown()
+        prober.shutdown()
+        writer.close()
+        conn.close()
+        if args.profile_startup:
+            print(profile.report(), file=sys.stderr)
@@ -1,132 +1,322 @@
+import asyncio
 import curses
 import os
+import signal
 import sys
 import time
-from threading import Lock, Thread
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 
-import vlc
-
-from components import ControlsBox, DirectoryMenu, NowPlaying, QuitDialog
-from item import DirectoryItem
+from components import (ControlsBox, DirectoryMenu, NowPlaying, QuitDialog,
+                        SearchDialog)
+from db import get_directory_media
+from item import DirectoryItem, ItemStore
 from log import logging
-from util import SEEK_STEP
-
-lock = Lock()
+from player import (RESUME_RETRIES, RESUME_SETTLE, RESUME_TOLERANCE, PlaybackClock,
+                    PlayerEvents, load_player, open_media, set_start_time)
+from playlist import Playlist
+from startup import StartupProfile
+from util import MAX_FPS, REPEAT_MODE, REPEAT_MODES, SEEK_STEP
 
 
 class MainForm:
-    def __init__(self, stdscr, filepath, cursor) -> None:
+    def __init__(self, stdscr, filepath, cursor, writer, prober, prefetcher, sort_mode,
+                 max_fps=MAX_FPS, repeat=REPEAT_MODE, shuffle=False, profile: StartupProfile = None) -> None:
+        self.profile = profile or StartupProfile()
+        # Everything touching the UI, the player status or the cursor runs on this loop's thread.
+        # Background threads hand their results over with `call_soon_threadsafe`.
+        # Nothing is scheduled on it unless something happens: no timers run while paused.
+        self.loop = asyncio.new_event_loop()
+        self.frame_interval = 1 / max_fps
+        self.last_render = 0
+        self.render_handle = None
+        self.tick_handle = None
         self.stdscr = stdscr
         self.cursor = cursor
+        self.writer = writer
+        self.prober = prober
+        self.prefetcher = prefetcher
 
         if os.path.isfile(filepath):
             self.filepath = os.path.dirname(os.path.abspath(filepath))
-            filename = DirectoryItem(self.cursor, filepath)
+            filename = ItemStore(self.writer, self.filepath).add(
+                os.path.basename(filepath), get_directory_media(self.cursor, self.filepath)
+            )
+            self.prober.probe([filename])
         else:
             self.filepath = os.path.abspath(filepath)
             filename = None
 
-        instance = vlc.Instance()
-        self.player = instance.media_player_new()
-        self.player.set_fullscreen(True)
-
         self.events = {
             # 155: self.handle_exit,
             # 27: self.handle_exit,
             "q": self.show_quit_dialog,
+            "f": self.show_search_dialog,
             curses.KEY_RESIZE: self.handle_resize,
             "o": self.skip_opening,
             "n": self.next_track,
             "p": self.previous_track,
+            "r": self.cycle_repeat,
+            "z": self.toggle_shuffle,
             " ": self.toggle_playback,
             "KEY_RIGHT": self.seek_forward,
             "KEY_LEFT": self.seek_backward,
         }
 
+        # Background probing may request a render before all components are created
+        self.status = {"time": 0, "state": "paused", "repeat": repeat, "shuffle": shuffle}
+        self.popup = None
+        self.components = []
+
+        # Player state comes from libvlc events, the position in between from an interpolated clock
+        self.clock = PlaybackClock()
+        # libvlc loads in the background while the UI is shown, see `player`
+        executor = ThreadPoolExecutor(1, thread_name_prefix='libvlc')
+        self.player_future = executor.submit(self.load_player)
+        executor.shutdown(wait=False)
+
+        # Active media, the queue it is played from, and the next track's media opened ahead of time
+        self.active_media = None
+        self.playlist = None
+        self.preloaded = None
+        # (start, seeks, loop time to check from) while confirming a resumed track started at its savepoint
+        self.resume_check = None
+
         # UI components
+        ui_start = time.perf_counter()
         self.components = [
-            DirectoryMenu(self.stdscr, self.filepath, self.cursor, self.handle_file_selection),
+            DirectoryMenu(
+                self.stdscr, self.filepath, self.cursor, self.writer, self.prober, self.prefetcher,
+                self.handle_file_selection, self.run_soon, sort_mode,
+            ),
             ControlsBox(self.stdscr),
             NowPlaying(self.stdscr),
         ]
 
         # Popup components
-        self.popup = None
         self.quit_dialog = QuitDialog(self.stdscr, self.hide_popup)
-
-        self.status = {"time": 0, "state": "paused"}
+        self.search_dialog = SearchDialog(self.stdscr, self.jump_to_file, self.hide_popup, self.run_soon)
 
         if filename:
-            self.status["state"] = "playing"
-            self.play_selected_track(filename)
-
-        # Active media
-        self.active_media = None
+            # Play the listed item, so the rest of the directory follows it
+            self.components[0].select_filepath(filename.filepath)
+            if self.components[0].selected.filepath == filename.filepath:
+                filename = self.components[0].selected
+            # Once libvlc is loaded, the listing can be browsed meanwhile
+            self.player_future.add_done_callback(
+                lambda future: self.run_soon(partial(self.play_selected_track, filename)))
 
         # Active component
         self.active_component = 0
         self.components[0].activate()
 
-        # Initial render
-        self.render()
+        # Components draw into their own windows. stdscr is refreshed once, so reading keys from it,
+        # which refreshes it, does not paint over them.
+        self.stdscr.noutrefresh()
 
-        # Poll playing status every second in a new thread
-        status_loop = Thread(target=self.status_loop)
-        status_loop.daemon = True
-        status_loop.start()
+        self.profile.record('ui', ui_start)
+
+        # Initial render
+        with self.profile.phase('first frame'):
+            self.render()
+
+        # Keys are read when stdin is readable, never blocking the loop
+        self.stdscr.nodelay(True)
+        self.loop.add_reader(sys.stdin.fileno(), self.handle_input)
+        # The signal replaces the curses handler that would queue KEY_RESIZE
+        self.loop.add_signal_handler(signal.SIGWINCH, self.handle_sigwinch)
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_forever()
+        finally:
+            self.loop.close()
+
+    def load_player(self):
+        player = load_player(self.profile)
+        self.player_events = PlayerEvents(player, self.clock, self.player_event)
+        logging.info(f"libvlc loaded after {(time.perf_counter() - self.profile.origin) * 1000:.0f} ms")
+        return player
+
+    @property
+    def player(self):
+        """
+        The libvlc media player, waiting for libvlc to load if it hasn't yet
+        """
+        return self.player_future.result()
 
+    def handle_input(self):
+        """
+        Handle all keys read so far, then render once. Held keys are applied as a batch, so the
+        screen never falls behind the input. curses may also buffer several keys from one read
+        of stdin, which would not make stdin readable again.
+        """
         while True:
             try:
                 key = self.stdscr.getkey()
-                if key in self.events:
-                    self.events[key]()
-                elif self.popup:
-                    self.popup.receive_input(key)
-                else:
-                    self.components[self.active_component].receive_input(key)
-                self.render()
+            except curses.error:
+                # No more input
+                break
+            try:
+                self.handle_key(key)
             except Exception as e:
                 logging.exception(e)
                 sys.exit(0)
+        self.request_render()
+
+    def handle_key(self, key):
+        receiver = self.popup or self.components[self.active_component]
+        if receiver.text_input:
+            receiver.receive_input(key)
+        elif key in self.events:
+            self.events[key]()
+        elif self.popup:
+            self.popup.receive_input(key)
+        else:
+            self.components[self.active_component].receive_input(key)
+        # The component receiving keys is redrawn after each one
+        (self.popup or self.components[self.active_component]).dirty = True
+
+    def handle_sigwinch(self):
+        size = os.get_terminal_size()
+        curses.resizeterm(size.lines, size.columns)
+        self.handle_resize()
+        self.request_render()
+
+    def request_render(self):
+        """
+        Render once at the end of the current loop iteration, however many updates ask for it,
+        and not sooner than a frame interval after the last render.
+        """
+        if self.render_handle:
+            return
+        delay = self.last_render + self.frame_interval - self.loop.time()
+        if delay > 0:
+            self.render_handle = self.loop.call_later(delay, self.render_frame)
+        else:
+            self.render_handle = self.loop.call_soon(self.render_frame)
+
+    def render_frame(self):
+        self.render_handle = None
+        self.last_render = self.loop.time()
+        self.render()
 
     def render(self):
-        self.stdscr.erase()
+        """
+        Draw the components that changed and update the terminal once.
+        """
+        drawn = False
         for component in self.components:
-            component.render(self.status)
+            drawn = component.render(self.status) or drawn
         if self.popup:
+            # Stay on top of the components drawn below
+            self.popup.dirty |= drawn
             self.popup.render()
-        self.stdscr.refresh()
+        curses.doupdate()
+
+    def run_soon(self, callback=None):
+        """
+        Apply an update from a background thread, if any, on the event loop and render it
+        """
+        self.loop.call_soon_threadsafe(self.apply_update, callback)
+
+    def apply_update(self, callback=None):
+        if callback:
+            callback()
+        self.request_render()
 
     def handle_resize(self):
+        self.stdscr.clear()
+        self.stdscr.noutrefresh()
         for component in self.components:
             component.restart()
-        self.stdscr.clear()
+        if self.popup:
+            self.popup.restart()
+            self.popup.activate()
 
     def handle_exit(self):
         sys.exit(0)
 
-    def status_loop(self):
-        while True:
-            try:
-                self.status["time"] = self.player.get_time()
-                self.status["state"] = "playing" if self.player.is_playing() else "paused"
-
-                with lock:
-                    self.render()
-
-                # TODO: Make this configurable
-                # TODO: Move inside lock - ???
-                if self.status["time"] and self.status["time"] // 1000 % 2 == 0:
-                    if self.active_media and self.status["time"] - 1000 > 0:
-                        self.active_media.make_savepoint(self.status["time"] - 1000)
-            except:
-                logging.exception("Error in status loop")
-            time.sleep(.5)
-
-
-    def play_selected_track(self, track: DirectoryItem | None):
+    def tick(self):
+        """
+        Redraw the playback position on every second of playback. Only scheduled while playing.
+        """
+        self.status["time"] = self.clock.now()
+        # TODO: Make this configurable
+        if self.status["time"] // 1000 % 2 == 0:
+            self.save_position()
+        self.request_render()
+        # Next tick when the next second is reached
+        self.tick_handle = self.loop.call_later(1 - self.clock.now() % 1000 / 1000, self.tick)
+
+    def start_ticking(self):
+        if not self.tick_handle:
+            self.tick()
+
+    def stop_ticking(self):
+        if self.tick_handle:
+            self.tick_handle.cancel()
+            self.tick_handle = None
+
+    def save_position(self):
+        if self.active_media and self.status["time"] - 1000 > 0:
+            self.make_savepoint(self.status["time"] - 1000)
+
+    def make_savepoint(self, stoptime):
+        icon = self.active_media.status_icon
+        self.active_media.make_savepoint(stoptime)
+        if self.active_media.status_icon != icon:
+            # Redraw the listing with the new watch state of the active media
+            self.components[0].dirty = True
+
+    def player_event(self, name, value):
+        # Called on a libvlc thread
+        self.loop.call_soon_threadsafe(self.handle_player_event, name, value)
+
+    def handle_player_event(self, name, value):
+        """
+        Apply a libvlc event to the playback status
+        """
+        logging.debug(f"Player event: {name} ({value})")
+        if name == "playing":
+            self.status["state"] = "playing"
+            self.start_ticking()
+        elif name in ("paused", "stopped", "ended"):
+            self.status["state"] = "paused"
+            self.stop_ticking()
+            self.status["time"] = self.clock.now()
+            if name == "ended":
+                self.track_ended()
+            elif name == "paused":
+                self.save_position()
+        elif name == "time":
+            self.status["time"] = value
+            if self.resume_check:
+                self.confirm_resume(value)
+        elif name == "length" and value > 0:
+            self.status["length"] = value
+        self.request_render()
+
+    def track_ended(self):
+        """
+        The active media was played to its end
+        """
+        logging.info(f"Reached end of {repr(self.active_media)}")
+        if self.active_media:
+            self.make_savepoint(self.status.get("length") or self.status["time"])
+        track = self.playlist.advance(auto=True) if self.playlist else None
+        if track:
+            self.play_track(track)
+
+    def play_selected_track(self, track: DirectoryItem | None, start: int | None = None):
+        """
+        Play `track`, or the selected item, from `start` or its savepoint, and continue the playlist from it.
+        """
         if self.player.is_playing():
+            self.status["time"] = self.clock.now()
+            self.save_position()
             self.player.stop()
+        # Persist the last savepoint of the previous track
+        self.writer.flush(wait=False)
 
         if not track:
             media_item = self.components[0].selected
@@ -135,16 +325,88 @@ class MainForm:
 
         self.active_media = media_item
         logging.info(f"Active media: {repr(self.active_media)}")
+        if self.playlist and self.playlist.store is media_item.store:
+            self.playlist.jump(media_item.row)
+        else:
+            self.playlist = Playlist(media_item.store, media_item.row,
+                                     self.status["repeat"], self.status["shuffle"])
 
-        media = vlc.Media(media_item.filepath)
+        media = self.take_preloaded(media_item)
         logging.info(f"Playing {repr(media_item)}")
+        start = media_item.stoptime if start is None else start
+        self.end_resume_check()
+        if start:
+            set_start_time(media, start)
+            self.resume_check = (start, 0, 0)
+            self.player_events.forward_time = True
+        self.clock.stop()
+        self.clock.set(start or 0)
+        self.status["time"] = start or 0
         self.player.set_media(media)
+        # The player holds its own reference
+        media.release()
         self.player.play()
-        if media_item.stoptime:
-            self.player.set_time(media_item.stoptime)
 
         self.status["length"] = media_item.duration
         self.status["title"] = media_item.title
+        self.preload_next()
+
+    def confirm_resume(self, position):
+        """
+        Check the position reported after resuming a track, and seek to the savepoint again only
+        if libvlc didn't start there, e.g. when the demuxer can't seek while opening the file.
+        """
+        start, seeks, check_from = self.resume_check
+        if self.loop.time() < check_from:
+            # Times reported before the last seek was applied
+            return
+        if abs(position - start) <= RESUME_TOLERANCE:
+            logging.debug(f"Resumed at {position} ms after {seeks} seeks")
+            self.end_resume_check()
+        elif seeks >= RESUME_RETRIES:
+            logging.warning(f"Could not resume {repr(self.active_media)} at {start} ms, playing at {position} ms")
+            self.end_resume_check()
+        else:
+            logging.info(f"Playback started at {position} ms instead of {start} ms, seeking")
+            self.player.set_time(start)
+            self.resume_check = (start, seeks + 1, self.loop.time() + RESUME_SETTLE)
+
+    def end_resume_check(self):
+        if self.resume_check:
+            self.resume_check = None
+            self.player_events.forward_time = False
+
+    def play_track(self, track: DirectoryItem):
+        """
+        Play a track reached through the playlist. Tracks played before start over.
+        """
+        self.play_selected_track(track, 0 if track.was_played or track == self.active_media else None)
+
+    def take_preloaded(self, track: DirectoryItem):
+        """
+        Returns the media of `track`, the preloaded one if it was opened ahead of time.
+        """
+        media, self.preloaded = self.preloaded, None
+        if media and media[0] == track.filepath:
+            return media[1]
+        if media:
+            media[1].release()
+        return open_media(self.player, track.filepath)
+
+    def preload_next(self):
+        """
+        Open and parse the media of the track that plays next in the background, so starting it
+        doesn't wait for the file to be opened and its demuxer to be set up.
+        """
+        track = self.playlist.peek(auto=True) if self.playlist else None
+        if not track or track == self.active_media:
+            return
+        if self.preloaded:
+            if self.preloaded[0] == track.filepath:
+                return
+            self.preloaded[1].release()
+        self.preloaded = (track.filepath, open_media(self.player, track.filepath, preparse=True))
+        logging.debug(f"Preloading {repr(track)}")
 
     # =========================
     # Track management methods
@@ -162,44 +424,78 @@ class MainForm:
             self.status["title"] = selected_fn.title
             self.play_selected_track(selected_fn)
 
+    def jump_to_file(self, filepath):
+        """
+        Open the directory of a library search result and select it
+        """
+        self.hide_popup()
+        dirname = os.path.dirname(filepath)
+        if not os.path.isdir(dirname):
+            logging.warning(f"Directory of search result no longer exists: {filepath}")
+            return
+        self.filepath = dirname
+        logging.info(f"Jumping to {filepath}")
+        self.components[0].change_directory(self.filepath)
+        self.components[0].select_filepath(filepath)
+
     def toggle_playback(self):
+        if not self.active_media:
+            return
         if self.status["state"] == "playing":
             self.player.pause()
         else:
             self.player.play()
 
+    def seek(self, position):
+        # A seek by the user overrides resuming at the savepoint
+        self.end_resume_check()
+        self.player.set_time(position)
+
     def skip_opening(self):
-        self.player.set_time(self.status["time"] + 88_000)
+        if not self.active_media:
+            return
+        self.seek(self.clock.now() + 88_000)
 
     def seek_backward(self):
         if self.status["state"] == "playing":
-            self.player.set_time(self.status["time"] - SEEK_STEP * 1000)
+            self.seek(self.clock.now() - SEEK_STEP * 1000)
 
     def seek_forward(self):
         if self.status["state"] == "playing":
-            self.player.set_time(self.status["time"] + SEEK_STEP * 1000)
+            self.seek(self.clock.now() + SEEK_STEP * 1000)
 
     def next_track(self):
         """
-        Play next media in directory. If last media, do nothing
+        Play next media in the playlist. If last media, do nothing
         """
-        # TODO: Fix for DirectoryItem objects
-        playing_idx = self.components[0].items.index(self.status["title"])
-        if playing_idx == len(self.components[0].items) - 1:
+        track = self.playlist.advance(1) if self.playlist else None
+        if not track:
             logging.warning("Reached end of playlist")
             return
-        self.play_selected_track(self.components[0].items[playing_idx + 1])
+        self.play_track(track)
 
     def previous_track(self):
         """
-        Play previous media in directory. If first media, do nothing
+        Play previous media in the playlist. If first media, do nothing
         """
-        # TODO: Fix for DirectoryItem objects
-        playing_idx = self.components[0].items.index(self.status["title"])
-        if playing_idx == 0:
+        track = self.playlist.advance(-1) if self.playlist else None
+        if not track:
             logging.warning("Reached beginning of playlist")
             return
-        self.play_selected_track(self.components[0].items[playing_idx - 1])
+        self.play_track(track)
+
+    def cycle_repeat(self):
+        repeat = REPEAT_MODES[(REPEAT_MODES.index(self.status["repeat"]) + 1) % len(REPEAT_MODES)]
+        self.status["repeat"] = repeat
+        if self.playlist:
+            self.playlist.repeat = repeat
+        self.preload_next()
+
+    def toggle_shuffle(self):
+        self.status["shuffle"] = not self.status["shuffle"]
+        if self.playlist:
+            self.playlist.set_shuffle(self.status["shuffle"])
+        self.preload_next()
 
     # =========================
     # Popup management methods
@@ -213,7 +509,18 @@ class MainForm:
         self.popup = self.quit_dialog
         self.popup.restart()
         self.popup.activate()
-        self.render()
+        self.request_render()
+
+    def show_search_dialog(self):
+        """
+        Deactivate the active component and render library search on top of other components
+        """
+        self.components[self.active_component].deactivate()
+        self.popup = self.search_dialog
+        self.popup.clear()
+        self.popup.restart()
+        self.popup.activate()
+        self.request_render()
 
     def hide_popup(self):
         """
@@ -223,5 +530,9 @@ class MainForm:
             self.popup.deactivate()
         self.popup = None
         self.components[self.active_component].activate()
-        self.stdscr.clear()
-        self.render()
+        # Redraw what the popup covered, including the rows between the component windows
+        self.stdscr.erase()
+        self.stdscr.noutrefresh()
+        for component in self.components:
+            component.dirty = True
+        self.request_render()
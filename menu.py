@@ -60,11 +60,22 @@ class Menu:
             self.select(0)
         if key == 'G' and self.selected < len(self.items) - 1:
             self.select(len(self.items) - 1)
+        self.scroll_to_selected()
+
+    def scroll_to_selected(self):
         if self.selected < self.scroll_start:
             self.scroll_up(self.scroll_start - self.selected)
         if self.selected > self.scroll_end:
             self.scroll_down(self.selected - self.scroll_end)
 
+    def items_changed(self):
+        """
+        Recompute the visible range after rows were added or removed.
+        """
+        self.selected = max(0, min(self.selected, len(self.items) - 1))
+        self.scroll_end = min(len(self.items), self.scroll_start + self.available_space) - 1
+        self.scroll_to_selected()
+
     def scroll_up(self, amount):
         self.scroll_start -= amount
         self.scroll_end -= amount
@@ -125,6 +136,7 @@ class TableMenu(Menu):
         flexible_cols = [c for c in columns if c.width == 0]
         for col in flexible_cols:
             col.width = free_row_width // len(flexible_cols)
+        self.widths = tuple(c.width for c in self.columns)
 
         super().__init__(stdscr, items, starty, startx, endy, endx, active, selected, scroll_start)
 
@@ -134,6 +146,16 @@ class TableMenu(Menu):
         """
         return self.SEPARATOR.join([self.columns[i].align_item(item) for i, item in enumerate(row)])
 
+    def format_row(self, idx, row) -> str:
+        """
+        Returns the formatted row at `idx`. Items that cache formatted rows (see `item.RowsView`)
+        format each row only once per column layout.
+        """
+        formatted = getattr(self.items, 'formatted', None)
+        if formatted:
+            return formatted(idx, self)
+        return self.render_table_row(row)
+
     def render(self, status: dict = None):
         scry, scrx = self.stdscr.getmaxyx()
         for i, item_idx in enumerate(range(self.scroll_start, self.scroll_end + 1)):
@@ -148,4 +170,4 @@ class TableMenu(Menu):
                     color = 12
                 if selected:
                     color = 6
-                self.print_string(y, x, self.render_table_row(item), color)
+                self.print_string(y, x, self.format_row(item_idx, item), color)
@@ -0,0 +1,58 @@
+import mmap
+import os
+import struct
+
+MP4_EXTS = ('.mp4', '.m4v', '.mov')
+
+
+def find_box(data, start: int, end: int, kind: bytes) -> tuple:
+    """
+    Walk the box headers between `start` and `end` and return the (payload start, box end) of the first
+    box of the given type. Only headers are read, box payloads are skipped.
+    """
+    offset = start
+    while offset + 8 <= end:
+        size, box_kind = struct.unpack_from('>I4s', data, offset)
+        header = 8
+        if size == 1:
+            # 64-bit box size follows the type
+            size = struct.unpack_from('>Q', data, offset + 8)[0]
+            header = 16
+        elif size == 0:
+            # Box extends to the end of its parent
+            size = end - offset
+        if size < header:
+            raise ValueError(f'Invalid size of box {box_kind!r} at {offset}')
+        if box_kind == kind:
+            return offset + header, min(offset + size, end)
+        offset += size
+    raise ValueError(f'Box {kind!r} not found')
+
+
+def read_duration(filepath) -> float:
+    """
+    Read the duration in milliseconds from the `moov/mvhd` box of an MP4 file.
+    The file is memory-mapped, so only the pages holding box headers are read from disk,
+    wherever `moov` is placed. Raises ValueError if the file can't be parsed.
+    """
+    with open(filepath, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if not size:
+            raise ValueError(f'Empty file: {filepath}')
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            try:
+                moov_start, moov_end = find_box(data, 0, size, b'moov')
+                mvhd, _ = find_box(data, moov_start, moov_end, b'mvhd')
+                if data[mvhd] == 1:
+                    # version, flags, 64-bit creation and modification times
+                    timescale, duration = struct.unpack_from('>IQ', data, mvhd + 20)
+                    unknown = 0xFFFFFFFFFFFFFFFF
+                else:
+                    timescale, duration = struct.unpack_from('>II', data, mvhd + 12)
+                    unknown = 0xFFFFFFFF
+            except (struct.error, IndexError) as e:
+                raise ValueError(f'Truncated MP4 file: {filepath}') from e
+
+    if not timescale or duration == unknown:
+        raise ValueError(f'No duration in MP4 header: {filepath}')
+    return duration / timescale * 1_000
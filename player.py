@@ -0,0 +1,135 @@
+import time
+from threading import Lock
+from typing import TYPE_CHECKING, Callable
+
+from startup import StartupProfile
+
+if TYPE_CHECKING:
+    import vlc
+
+# Milliseconds a libvlc time event may lag behind the interpolated clock without moving it back
+TIME_JITTER = 300
+# Milliseconds a resumed track may start away from its savepoint, e.g. at the keyframe before it
+RESUME_TOLERANCE = 3000
+# Seeks to the savepoint when libvlc didn't start at it, and seconds to wait for the position after each
+RESUME_RETRIES = 2
+RESUME_SETTLE = 0.5
+
+
+class PlaybackClock:
+    """
+    Playback position in milliseconds, interpolated with a monotonic clock between libvlc time events.
+    libvlc only reports the time a few times per second, and not at all while paused.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.position = 0
+        self.anchor = time.monotonic()
+        self.running = False
+
+    def _now(self) -> int:
+        if not self.running:
+            return self.position
+        return self.position + int((time.monotonic() - self.anchor) * 1000)
+
+    def now(self) -> int:
+        with self.lock:
+            return self._now()
+
+    def set(self, position: int):
+        with self.lock:
+            # Small lags are libvlc's coarse reporting, moving back would make the progress bar jitter
+            if self.running and 0 <= self._now() - position < TIME_JITTER:
+                return
+            self.position = position
+            self.anchor = time.monotonic()
+
+    def start(self):
+        with self.lock:
+            if not self.running:
+                self.anchor = time.monotonic()
+                self.running = True
+
+    def stop(self):
+        with self.lock:
+            self.position = self._now()
+            self.running = False
+
+
+def load_player(profile: StartupProfile) -> 'vlc.MediaPlayer':
+    """
+    Import libvlc and create a fullscreen media player. Slow, libvlc loads all of its plugins,
+    so it is called on a background thread while the UI is already shown.
+    """
+    with profile.phase('import vlc'):
+        import vlc
+    with profile.phase('libvlc instance'):
+        instance = vlc.Instance()
+        player = instance.media_player_new()
+        player.set_fullscreen(True)
+    return player
+
+
+def open_media(player: 'vlc.MediaPlayer', filepath: str, preparse: bool = False) -> 'vlc.Media':
+    """
+    Create the media of a file on the player's libvlc instance. `preparse` opens the file and probes
+    its tracks in the background.
+    """
+    import vlc
+    media = player.get_instance().media_new(filepath)
+    if preparse:
+        # Asynchronous, libvlc parses the file on its own thread
+        media.parse_with_options(vlc.MediaParseFlag.local, 0)
+    return media
+
+
+def set_start_time(media: 'vlc.Media', start: int):
+    """
+    Start playing `media` at `start` milliseconds. The demuxer seeks when the file is opened,
+    instead of decoding from 0 until a seek catches up.
+    """
+    media.add_option(f':start-time={start / 1000:.3f}')
+
+
+class PlayerEvents:
+    """
+    Forwards the events of a libvlc media player as `handler(name, value)`.
+
+    libvlc calls event callbacks on its own threads, where calling back into libvlc or waiting for the UI
+    (which may be stopping the player) deadlocks. The handler must only hand the event over, e.g. with
+    `call_soon_threadsafe`. Time events only move the clock, unless playback is paused (e.g. seeking
+    while paused) or `forward_time` is set.
+    """
+
+    def __init__(self, player: 'vlc.MediaPlayer', clock: PlaybackClock, handler: Callable[[str, int], None]):
+        import vlc
+        self.clock = clock
+        self.handler = handler
+        self.forward_time = False
+        events = {
+            vlc.EventType.MediaPlayerPlaying: 'playing',
+            vlc.EventType.MediaPlayerPaused: 'paused',
+            vlc.EventType.MediaPlayerStopped: 'stopped',
+            vlc.EventType.MediaPlayerEndReached: 'ended',
+            vlc.EventType.MediaPlayerTimeChanged: 'time',
+            vlc.EventType.MediaPlayerLengthChanged: 'length',
+        }
+        manager = player.event_manager()
+        for event_type, name in events.items():
+            manager.event_attach(event_type, self.on_event, name)
+
+    def on_event(self, event, name):
+        value = None
+        if name == 'playing':
+            self.clock.start()
+        elif name in ('paused', 'stopped', 'ended'):
+            self.clock.stop()
+        elif name == 'time':
+            value = event.u.new_time
+            self.clock.set(value)
+            if self.clock.running and not self.forward_time:
+                return
+        elif name == 'length':
+            value = event.u.new_length
+        self.handler(name, value)
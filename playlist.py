@@ -0,0 +1,127 @@
+import random
+from typing import List
+
+from item import IS_MEDIA, REMOVED, DirectoryItem, ItemStore
+from util import REPEAT_MODE
+
+
+class Playlist:
+    """
+    Playback queue over the media of one directory listing, in the listing's current order.
+
+    Tracks are read from the store's `order` whenever the next one is needed, so files added, removed
+    or re-sorted while playing are followed. `repeat` is one of `REPEAT_MODES`: at the end of the
+    listing 'all' starts over, and 'one' replays the current track when it ends. With `shuffle`,
+    every track is played once in random order before any is repeated.
+    """
+
+    def __init__(self, store: ItemStore, row: int, repeat: str = REPEAT_MODE, shuffle: bool = False):
+        self.store = store
+        self.row = row
+        self.repeat = repeat
+        self.shuffle = shuffle
+        # Shuffled tracks played so far, most recent last, and the ones played in this round
+        self.history = []
+        self.played = {row}
+        # Shuffled tracks gone back from with previous, the next one last
+        self.forward = []
+        # Next shuffled track, drawn ahead of time so it can be preloaded
+        self.upcoming = None
+
+    @property
+    def current(self) -> DirectoryItem:
+        return DirectoryItem(self.store, self.row)
+
+    def tracks(self) -> List[int]:
+        """
+        Returns the rows of the listed media, in display order.
+        """
+        flags = self.store.flags
+        return [row for row in self.store.order if flags[row] & IS_MEDIA and not flags[row] & REMOVED]
+
+    def jump(self, row: int):
+        """
+        Continue from the given row, e.g. a track selected in the listing.
+        """
+        if row == self.row:
+            return
+        self.history.append(self.row)
+        self.row = row
+        self.played.add(row)
+        self.forward = []
+        self.upcoming = None
+
+    def peek(self, step: int = 1, auto: bool = False) -> DirectoryItem | None:
+        """
+        Returns the track `step` (1 or -1) away from the current one without moving to it, or None at
+        either end of the playlist. `auto` is set when the current track ended by itself.
+        """
+        row = self._step(step, auto)
+        return None if row is None else DirectoryItem(self.store, row)
+
+    def advance(self, step: int = 1, auto: bool = False) -> DirectoryItem | None:
+        """
+        Move to the next (1) or previous (-1) track and return it, or None at either end of the playlist.
+        """
+        row = self._step(step, auto)
+        if row is None:
+            return None
+        if self.shuffle and step < 0:
+            # Going back through the history, the way forward is kept
+            self.history.pop()
+            self.forward.append(self.row)
+            self.row = row
+        elif row != self.row:
+            if self.forward and self.forward[-1] == row:
+                self.forward.pop()
+            elif row == self.upcoming:
+                self.upcoming = None
+            self.history.append(self.row)
+            self.row = row
+            self.played.add(row)
+        return self.current
+
+    def set_shuffle(self, shuffle: bool):
+        self.shuffle = shuffle
+        self.played = {self.row}
+        self.forward = []
+        self.upcoming = None
+
+    def _step(self, step: int, auto: bool) -> int | None:
+        if auto and self.repeat == 'one':
+            return self.row
+        tracks = self.tracks()
+        if not tracks:
+            return None
+        if self.shuffle:
+            return self._shuffled_step(step, tracks)
+
+        if self.row in tracks:
+            idx = tracks.index(self.row) + step
+        else:
+            # The current track is no longer listed: continue from where it would be
+            idx = sum(1 for row in tracks if self.store.sort_key(row) < self.store.sort_key(self.row))
+            idx += step if step < 0 else 0
+        if 0 <= idx < len(tracks):
+            return tracks[idx]
+        if self.repeat == 'all':
+            return tracks[idx % len(tracks)]
+        return None
+
+    def _shuffled_step(self, step: int, tracks: List[int]) -> int | None:
+        if step < 0:
+            return self.history[-1] if self.history else None
+        # Tracks removed from the listing are skipped
+        while self.forward and self.forward[-1] not in tracks:
+            self.forward.pop()
+        if self.forward:
+            return self.forward[-1]
+        if self.upcoming is not None and self.upcoming in tracks:
+            return self.upcoming
+        remaining = [row for row in tracks if row not in self.played]
+        if not remaining and self.repeat == 'all':
+            # Start a new round, not repeating the current track first unless it's the only one
+            self.played = {self.row}
+            remaining = [row for row in tracks if row != self.row] or tracks
+        self.upcoming = random.choice(remaining) if remaining else None
+        return self.upcoming
@@ -0,0 +1,138 @@
+import logging
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock, Timer
+
+from db import connect
+from item import DirectoryListing, DirectoryView
+from util import PREFETCH_DELAY, PREFETCH_WORKERS
+
+# Nice value of prefetch threads, so they yield the CPU to the UI and to probing
+PREFETCH_NICENESS = 10
+# Number of finished prefetches kept until the directory is entered
+PREFETCH_KEEP = 4
+
+
+class Prefetch:
+    """
+    Listing of a directory being loaded in the background, see `Prefetcher`.
+    """
+
+    def __init__(self, dirpath: str):
+        self.dirpath = dirpath
+        self.mtime = None
+        # Set once the entries are read, the items are loaded in chunks after that
+        self.listing = None
+        self.future = None
+        # Set when the directory is entered, loading continues on the menu's loader thread
+        self.taken = False
+        self.cancelled = False
+
+    @property
+    def done(self) -> bool:
+        return self.future.done()
+
+    def cancel(self):
+        self.cancelled = True
+        self.future.cancel()
+        if self.listing:
+            self.listing.cancelled = True
+
+
+class Prefetcher:
+    """
+    Scans directories in the background at low priority, before they are entered.
+    Only the latest hovered directory is loaded, unfinished prefetches of others are cancelled.
+    """
+
+    def __init__(self, writer, workers: int = PREFETCH_WORKERS, delay: float = PREFETCH_DELAY):
+        self.writer = writer
+        self.delay = delay
+        self.local = threading.local()
+        self.pool = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix='prefetch', initializer=self.init_worker
+        )
+        self.lock = Lock()
+        self.prefetches = OrderedDict()  # dirpath -> Prefetch
+        self.timer = None
+
+    def init_worker(self):
+        try:
+            os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), PREFETCH_NICENESS)
+        except OSError:
+            pass
+        # Every worker reads the database through its own connection
+        self.local.conn = connect()
+
+    def schedule(self, dirpath: str):
+        """
+        Prefetch the directory once the selection rested on it for `delay` seconds.
+        """
+        self.cancel_timer()
+        self.timer = Timer(self.delay, self.start, (dirpath,))
+        self.timer.daemon = True
+        self.timer.start()
+
+    def cancel_timer(self):
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+
+    def start(self, dirpath: str):
+        with self.lock:
+            if dirpath in self.prefetches:
+                return
+            self.cancel_unfinished()
+            prefetch = Prefetch(dirpath)
+            prefetch.future = self.pool.submit(self.scan, prefetch)
+            self.prefetches[dirpath] = prefetch
+            while len(self.prefetches) > PREFETCH_KEEP:
+                self.prefetches.popitem(last=False)
+
+    def scan(self, prefetch: Prefetch):
+        try:
+            prefetch.mtime = os.stat(prefetch.dirpath).st_mtime_ns
+            listing = DirectoryListing(self.writer, prefetch.dirpath)
+        except OSError:
+            logging.exception(f'Failed to prefetch {prefetch.dirpath}')
+            return
+        with self.lock:
+            if prefetch.cancelled:
+                return
+            prefetch.listing = listing
+        cursor = self.local.conn.cursor()
+        while not listing.loaded and not listing.cancelled and not prefetch.taken:
+            listing.load_chunk(cursor)
+
+    def cancel_unfinished(self):
+        for dirpath, prefetch in list(self.prefetches.items()):
+            if not prefetch.done:
+                prefetch.cancel()
+                del self.prefetches[dirpath]
+
+    def take(self, dirpath: str) -> DirectoryView | None:
+        """
+        Return the prefetched listing of a directory that is being entered, without waiting for it.
+        A listing that is still loading is handed over as it is, with `listing` set. A prefetch that
+        hasn't read the entries yet is cancelled, as are the prefetches of other directories.
+        """
+        self.cancel_timer()
+        with self.lock:
+            prefetch = self.prefetches.pop(dirpath, None)
+            if prefetch:
+                # Stops the worker after the chunk it is loading
+                prefetch.taken = True
+            self.cancel_unfinished()
+            if prefetch and not prefetch.listing:
+                prefetch.cancel()
+                return None
+        if not prefetch:
+            return None
+        listing = prefetch.listing
+        return DirectoryView(listing.items, prefetch.mtime, listing=None if listing.loaded else listing)
+
+    def shutdown(self):
+        self.cancel_timer()
+        self.pool.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,104 @@
+import logging
+import subprocess
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import partial
+from typing import Callable, List
+
+from item import DirectoryItem
+from util import PROBE_BACKEND, PROBE_WORKERS, get_media_length
+
+
+def probe_media_length(filepath, backend=PROBE_BACKEND) -> float | None:
+    """
+    Returns the media length in milliseconds, or None if the file could not be probed.
+    """
+    try:
+        return get_media_length(filepath, backend)
+    except (OSError, subprocess.SubprocessError, ValueError):
+        # Also a file removed since it was listed, or a missing ffprobe
+        logging.warning(f'Failed to probe media length: {filepath}')
+        return None
+
+
+class ProbeJob:
+    """
+    Background probing of one directory listing.
+    """
+
+    def __init__(self, callback: Callable[[DirectoryItem], None], update_handler: Callable[[Callable], None]):
+        self.callback = callback
+        self.update_handler = update_handler
+        self.futures = []
+        self.remaining = 0
+        self.cancelled = False
+
+    def cancel(self):
+        """
+        Drop files that are not being probed yet and stop reporting results.
+        """
+        self.cancelled = True
+        for future in self.futures:
+            future.cancel()
+
+    def probed(self, item: DirectoryItem, duration: float | None):
+        """
+        Store a probed duration, on the thread that reads the items.
+        The result is kept even if the job was cancelled, the file does not need probing again.
+        """
+        try:
+            item.set_duration(duration)
+        finally:
+            self.remaining -= 1
+            if not self.remaining:
+                # Save the whole listing in one transaction
+                item.writer.flush(wait=False)
+        if not self.cancelled:
+            self.callback(item)
+
+
+class Prober:
+    """
+    Probes media durations on a bounded pool of worker threads.
+    """
+
+    def __init__(self, workers: int = PROBE_WORKERS, backend: str = PROBE_BACKEND):
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='probe')
+        self.probe_media_length = partial(probe_media_length, backend=backend)
+
+    def probe(self, items: List[DirectoryItem]):
+        """
+        Probe every item that needs it in parallel and wait for all of them.
+        The durations are queued on the items' writer, so they are saved in one transaction.
+        """
+        pending = [item for item in items if item.is_media and item.needs_probe]
+        if not pending:
+            return
+        logging.info(f'Probing {len(pending)} files')
+        durations = self.pool.map(self.probe_media_length, [item.filepath for item in pending])
+        for item, duration in zip(pending, durations):
+            item.set_duration(duration)
+
+    def submit(self, items: List[DirectoryItem], callback: Callable[[DirectoryItem], None],
+               update_handler: Callable[[Callable], None], job: ProbeJob = None) -> ProbeJob:
+        """
+        Probe every item that needs it in the background. The durations are handed to `update_handler`,
+        which runs them on the event loop, so the items are only changed there. `callback` is then
+        called with each item once its duration is set, unless the job was cancelled.
+        If `job` is given, the items are added to it instead of a new job.
+        """
+        job = job or ProbeJob(callback, update_handler)
+        pending = [item for item in items if item.is_media and item.needs_probe]
+        job.remaining += len(pending)
+        for item in pending:
+            future = self.pool.submit(self.probe_media_length, item.filepath)
+            future.add_done_callback(partial(self._probed, job, item))
+            job.futures.append(future)
+        return job
+
+    def _probed(self, job: ProbeJob, item: DirectoryItem, future: Future):
+        if future.cancelled():
+            return
+        job.update_handler(partial(job.probed, item, future.result()))
+
+    def shutdown(self):
+        self.pool.shutdown(wait=False, cancel_futures=True)
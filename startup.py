@@ -0,0 +1,39 @@
+import threading
+import time
+from contextlib import contextmanager
+from threading import Lock
+
+
+class StartupProfile:
+    """
+    Timings of the phases of startup, reported with --profile-startup.
+    Phases may run on other threads, e.g. loading libvlc, so they can overlap.
+    """
+
+    def __init__(self, origin: float = None):
+        # perf_counter() at the start of the process, as far as it can be measured
+        self.origin = time.perf_counter() if origin is None else origin
+        # (name, start, end, thread), in seconds since origin
+        self.phases = []
+        self.lock = Lock()
+
+    @contextmanager
+    def phase(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, start)
+
+    def record(self, name: str, start: float, end: float = None):
+        end = time.perf_counter() if end is None else end
+        with self.lock:
+            self.phases.append((name, start - self.origin, end - self.origin, threading.current_thread().name))
+
+    def report(self) -> str:
+        lines = [f"{'phase':<20} {'start ms':>9} {'ms':>9}  thread"]
+        with self.lock:
+            phases = sorted(self.phases, key=lambda phase: phase[1])
+        for name, start, end, thread in phases:
+            lines.append(f"{name:<20} {start * 1000:>9.1f} {(end - start) * 1000:>9.1f}  {thread}")
+        return "\n".join(lines)
@@ -1,7 +1,35 @@
+import logging
+import os
 import subprocess
 
+import mp4
+
 SEEK_STEP = 5
 TRIGGER_WAS_PLAYED = 60 * 2 + 30    # Update media to mark played when less than 2m30s left
+FLUSH_INTERVAL = 30     # Seconds between writes of queued savepoints to the database
+MAX_FPS = 30            # Max screen updates per second
+SEARCH_LIMIT = 100      # Max number of library search results
+SEARCH_CANDIDATES = 2000    # Matches ranked per library search, the first ones found
+SEARCH_MIN_CHARS = 2    # Shorter words of a search query are ignored, they have no prefix index
+SEARCH_DELAY = 0.15     # Seconds without typing before the library is searched
+SCAN_CHUNK = 200        # Directory entries turned into listed items at a time
+DIRECTORY_CACHE_SIZE = 32   # Number of recently visited directory listings kept in memory
+PREFETCH_DELAY = 0.3    # Seconds the selection rests on a directory before it is scanned in the background
+PREFETCH_WORKERS = 1    # Directories prefetched at the same time
+WATCH_DEBOUNCE = 0.5    # Seconds without filesystem events before changes in the open directory are shown
+PROBE_WORKERS = os.cpu_count() or 4     # Parallel duration probes while scanning a directory
+# How media durations are read: 'mp4' parses MP4 headers in-process, 'ffprobe' runs ffprobe,
+# 'auto' parses MP4 headers and falls back to ffprobe when that fails
+PROBE_BACKENDS = ('auto', 'mp4', 'ffprobe')
+PROBE_BACKEND = 'auto'
+# Orders of directory listings, directories always come first:
+# 'name' sorts numbers in titles by value, 'duration' shortest first, 'unwatched' and 'in_progress'
+# list those first, 'recent' lists the most recently played first
+SORT_MODES = ('name', 'duration', 'unwatched', 'in_progress', 'recent')
+SORT_MODE = 'name'
+# What happens at the end of a directory's playlist: 'off' stops, 'all' starts over, 'one' repeats each track
+REPEAT_MODES = ('off', 'all', 'one')
+REPEAT_MODE = 'off'
 SUPPORTED_EXTS = [
     '.mp4',
 ]
@@ -14,13 +42,31 @@ def ms_to_hms(ms):
     return "%d:%02d:%02d" % (h, m, s)
 
 
+def is_supported(filename) -> bool:
+    return os.path.splitext(filename)[1] in SUPPORTED_EXTS
+
+
 def truncate(string, max_length):
     if len(string) > max_length:
         return string[:max_length] + "…"
     return string
 
 
-def get_media_length(filename):
+def get_media_length(filename, backend=PROBE_BACKEND):
+    """
+    Returns the media length in milliseconds.
+    """
+    if backend == 'mp4' or (backend == 'auto' and os.path.splitext(filename)[1] in mp4.MP4_EXTS):
+        try:
+            return mp4.read_duration(filename)
+        except (OSError, ValueError):
+            if backend == 'mp4':
+                raise
+            logging.debug(f'Failed to parse MP4 header, falling back to ffprobe: {filename}')
+    return ffprobe_media_length(filename)
+
+
+def ffprobe_media_length(filename):
     result = subprocess.run(["ffprobe", "-v", "error", "-show_entries",
                              "format=duration", "-of",
                              "default=noprint_wrappers=1:nokey=1", filename],
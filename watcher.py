@@ -0,0 +1,105 @@
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import struct
+from threading import Lock, Thread
+from typing import Callable, Set
+
+from util import WATCH_DEBOUNCE
+
+# inotify(7) constants
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_ONLYDIR = 0x01000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+
+WATCH_MASK = IN_CREATE | IN_CLOSE_WRITE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO | IN_ONLYDIR
+
+# struct inotify_event: wd, mask, cookie, len, followed by a NUL-padded name of `len` bytes
+EVENT = struct.Struct('iIII')
+
+
+class DirectoryWatcher(Thread):
+    """
+    Watches one directory at a time with Linux inotify.
+
+    Names of created, changed, deleted or renamed entries are collected until no new event arrives for
+    `debounce` seconds, then reported at once with `callback(dirpath, names)` from the watcher thread.
+    `names` is None if events were lost because the inotify queue overflowed, the whole directory
+    has to be read again then.
+    Raises OSError if inotify is not available.
+    """
+
+    def __init__(self, callback: Callable[[str, Set[str]], None], debounce: float = WATCH_DEBOUNCE):
+        super().__init__(name="directory-watcher", daemon=True)
+        self.callback = callback
+        self.debounce = debounce
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        self.lock = Lock()
+        self.wd = -1
+        self.dirpath = None
+        self.pending = set()
+        self.overflowed = False
+
+    def watch(self, dirpath: str):
+        """
+        Stop watching the previous directory and start watching `dirpath`.
+        """
+        with self.lock:
+            if dirpath == self.dirpath:
+                return
+            if self.wd >= 0:
+                self.libc.inotify_rm_watch(self.fd, self.wd)
+            self.wd = self.libc.inotify_add_watch(self.fd, os.fsencode(dirpath), WATCH_MASK)
+            if self.wd < 0:
+                logging.warning(f"Can't watch {dirpath}: {os.strerror(ctypes.get_errno())}")
+            self.dirpath = dirpath
+            self.pending = set()
+
+    def run(self):
+        while True:
+            with self.lock:
+                timeout = self.debounce if self.pending or self.overflowed else None
+            readable, _, _ = select.select([self.fd], [], [], timeout)
+            if readable:
+                self.read_events()
+                continue
+
+            # Quiet for `debounce` seconds, report everything collected so far
+            with self.lock:
+                dirpath, names, self.pending = self.dirpath, self.pending, set()
+                if self.overflowed:
+                    names, self.overflowed = None, False
+            try:
+                self.callback(dirpath, names)
+            except Exception:
+                logging.exception("Error handling directory changes")
+
+    def read_events(self):
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return
+        offset = 0
+        with self.lock:
+            while offset < len(data):
+                wd, mask, _, length = EVENT.unpack_from(data, offset)
+                name = data[offset + EVENT.size:offset + EVENT.size + length].rstrip(b'\0')
+                offset += EVENT.size + length
+                if mask & IN_Q_OVERFLOW:
+                    logging.warning("inotify queue overflowed, some directory changes were lost")
+                    self.overflowed = True
+                # Events of a previously watched directory may still be queued
+                if wd == self.wd and name:
+                    self.pending.add(os.fsdecode(name))